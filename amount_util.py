@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2022 tecnovert
+# Distributed under the MIT software license, see the accompanying
+# file LICENSE or http://www.opensource.org/licenses/mit-license.php.
+
+"""
+Integer amounts, shared by zap.py and join_cs_disbursements.py.
+
+Amounts are kept as ints in satoshis.
+The daemon writes amounts as numbers with 8 decimal places, json_loads parses
+those straight to ints with a parse_float hook, so no float or Decimal is
+involved.  Numbers that can't be amounts, with more than 8 decimal places
+like difficulty, are left as floats.
+A number like verificationprogress 0.5 would be taken as an amount, so
+rpc_json_loads only uses the hook for the methods in AMOUNT_METHODS.
+
+$ python amount_util.py
+
+"""
+
+import json
+
+
+COIN = 100000000
+MAX_SHIFT = 32  # Largest power of ten accepted from an exponent
+AMOUNT_METHODS = ('listunspent', 'listsinceblock', 'sendtypeto')  # RPC methods whose results are read as amounts
+
+
+def parse_amount(s):
+    """Parse a decimal string into satoshis, raises ValueError if it has more than 8 decimal places."""
+    s = s.strip()
+    sign = 1
+    if s[:1] in ('-', '+'):
+        if s[0] == '-':
+            sign = -1
+        s = s[1:]
+    mantissa, has_exponent, exponent = s.lower().partition('e')
+    whole, _, frac = mantissa.partition('.')
+    digits = whole + frac
+    if not digits.isdigit() or not digits.isascii():
+        raise ValueError('Invalid amount: ' + s)
+    try:
+        shift = 8 - len(frac) + (int(exponent) if has_exponent else 0)
+    except ValueError:
+        raise ValueError('Invalid amount: ' + s)
+    if shift > MAX_SHIFT:
+        raise ValueError('Invalid amount: ' + s)
+    if shift < 0:
+        if digits[shift:].strip('0') != '':
+            raise ValueError('More than 8 decimal places: ' + s)
+        return sign * int(digits[:shift] or '0')
+    return sign * int(digits) * 10 ** shift
+
+
+def parse_json_float(s):
+    try:
+        return parse_amount(s)
+    except ValueError:
+        return float(s)
+
+
+def json_loads(s):
+    """json.loads with numbers that have a fraction parsed as satoshis."""
+    return json.loads(s, parse_float=parse_json_float)
+
+
+def rpc_json_loads(s, methods):
+    """Parse the response to calls of methods, with json_loads if any of them is in AMOUNT_METHODS."""
+    if any(method in AMOUNT_METHODS for method in methods):
+        return json_loads(s)
+    return json.loads(s)
+
+
+def format8(i):
+    n = abs(i)
+    quotient = n // COIN
+    remainder = n % COIN
+    rv = '%d.%08d' % (quotient, remainder)
+    if i < 0:
+        rv = '-' + rv
+    return rv
+
+
+def test_amount_util():
+    print('test_amount_util()')
+
+    for s, expect in (('0', 0), ('1', COIN), ('0.1', 10000000), ('-0.00000001', -1), ('+12.5', 1250000000),
+                      ('21000000.00000000', 21000000 * COIN), ('1e-05', 1000), ('1.5E2', 150 * COIN), ('0.100000000000', 10000000)):
+        assert(parse_amount(s) == expect), s
+        assert(parse_amount(format8(expect)) == expect)
+    for s in ('', '.', '1.2.3', '0.000000001', 'nan', '1e', '1e999', '1,5', '١'):
+        try:
+            parse_amount(s)
+            assert(False), s
+        except ValueError:
+            pass
+
+    r = json_loads('{"amount": 0.30000000, "fee": 0.00001234, "difficulty": 4.656542373906925e-10, "height": 10}')
+    assert(r == {'amount': 30000000, 'fee': 1234, 'difficulty': 4.656542373906925e-10, 'height': 10})
+    assert(rpc_json_loads('{"verificationprogress": 0.5}', ['getblockchaininfo']) == {'verificationprogress': 0.5})
+    assert(rpc_json_loads('[{"amount": 0.5}]', ['listunspent']) == [{'amount': 50000000}])
+    assert(format8(-123456789) == '-1.23456789')
+
+    print('Passed.')
+
+
+if __name__ == '__main__':
+    test_amount_util()
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2022 tecnovert
+# Distributed under the MIT software license, see the accompanying
+# file LICENSE or http://www.opensource.org/licenses/mit-license.php.
+
+"""
+Address history index.
+Maps addresses to the outputs paying them, stored in sqlite.
+The first run indexes the whole chain, later runs only add new blocks.
+
+$ export BIN_PATH=~/tmp/particl-0.21.2.11/bin
+$ ${BIN_PATH}/particl-qt -server -txindex=1
+$ python address_index.py ~/.particl ~/address_index.db [address]
+
+"""
+
+import os
+import sys
+import time
+import sqlite3
+from util import callrpc
+
+
+class AddressIndex():
+    def __init__(self, db_path):
+        self.dbc = sqlite3.connect(db_path)
+
+        c = self.dbc.cursor()
+        c.execute('''CREATE TABLE IF NOT EXISTS blocks
+                     (height INTEGER PRIMARY KEY, blockhash TEXT)''')
+        c.execute('''CREATE TABLE IF NOT EXISTS address_outputs
+                     (address TEXT, txid TEXT, n INTEGER, height INTEGER, type TEXT)''')
+        c.execute('CREATE INDEX IF NOT EXISTS address_outputs_address ON address_outputs (address, height)')
+        c.execute('CREATE INDEX IF NOT EXISTS address_outputs_height ON address_outputs (height)')
+        self.dbc.commit()
+
+    def close(self):
+        self.dbc.close()
+
+    def get_height(self):
+        """Returns the height of the last indexed block, -1 if empty."""
+        row = self.dbc.execute('SELECT MAX(height) FROM blocks').fetchone()
+        return -1 if row[0] is None else row[0]
+
+    def rollback(self, height):
+        """Remove all blocks above height."""
+        self.dbc.execute('DELETE FROM address_outputs WHERE height > ?', (height, ))
+        self.dbc.execute('DELETE FROM blocks WHERE height > ?', (height, ))
+        self.dbc.commit()
+
+    def add_block(self, block_data):
+        height = block_data['height']
+        rows = []
+        for tx in block_data['tx']:
+            txid = tx['txid']
+            for txo in tx['vout']:
+                if 'scriptPubKey' not in txo or 'addresses' not in txo['scriptPubKey']:
+                    continue
+                for addr in txo['scriptPubKey']['addresses']:
+                    rows.append((addr, txid, txo['n'], height, txo['type']))
+        self.dbc.executemany('INSERT INTO address_outputs (address, txid, n, height, type) VALUES (?, ?, ?, ?, ?)', rows)
+        self.dbc.execute('INSERT INTO blocks (height, blockhash) VALUES (?, ?)', (height, block_data['hash']))
+
+    def update(self, callrpcw, commit_every=1000):
+        """Index blocks added to the chain since the last update."""
+        best_height = callrpcw('getblockcount')
+
+        # Remove blocks disconnected by a reorg
+        height = min(self.get_height(), best_height)
+        while height >= 0:
+            row = self.dbc.execute('SELECT blockhash FROM blocks WHERE height = ?', (height, )).fetchone()
+            if row is not None and row[0] == callrpcw('getblockhash', [height]):
+                break
+            height -= 1
+        self.rollback(height)
+
+        print('Indexing blocks {} to {}'.format(height + 1, best_height))
+        for h in range(height + 1, best_height + 1):
+            block_hash = callrpcw('getblockhash', [h])
+            self.add_block(callrpcw('getblock', [block_hash, 2]))
+            if h % commit_every == 0:
+                self.dbc.commit()
+            if h % 10000 == 0:
+                print('height', h, flush=True)
+        self.dbc.commit()
+        return best_height
+
+    def get_outputs(self, address, output_type='standard'):
+        """Returns (txid, n, height) for outputs paying address, most recent first."""
+        q = self.dbc.execute('SELECT txid, n, height FROM address_outputs WHERE address = ? AND type = ? ORDER BY height DESC',
+                             (address, output_type))
+        return q.fetchall()
+
+
+def make_rpc_func(rpc_port, rpc_auth, wallet=None):
+    rpc_port = rpc_port
+    rpc_auth = rpc_auth
+    wallet = wallet
+
+    def rpc_func(cmd, args=[], wallet_override=None):
+        nonlocal rpc_port, rpc_auth, wallet
+        return callrpc(rpc_port, rpc_auth, cmd, args, wallet if wallet_override is None else wallet_override)
+    return rpc_func
+
+
+def main():
+    particl_data_dir = os.path.expanduser(sys.argv[1])
+    db_filepath = os.path.expanduser(sys.argv[2])
+
+    chain = 'mainnet'
+
+    authcookiepath = os.path.join(particl_data_dir, '' if chain == 'mainnet' else chain, '.cookie')
+    for i in range(10):
+        if not os.path.exists(authcookiepath):
+            time.sleep(0.5)
+    with open(authcookiepath) as fp:
+        rpc_auth = fp.read()
+
+    rpc_port = 51735 if chain == 'mainnet' else 51935
+
+    callrpcw = make_rpc_func(rpc_port, rpc_auth)
+
+    address_index = AddressIndex(db_filepath)
+    height = address_index.update(callrpcw)
+    print('Indexed to height', height)
+
+    if len(sys.argv) > 3:
+        for txid, n, height in address_index.get_outputs(sys.argv[3]):
+            print(txid, n, height)
+
+    address_index.close()
+
+
+if __name__ == '__main__':
+    main()
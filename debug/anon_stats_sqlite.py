@@ -33,6 +33,7 @@ from util import (
     COIN,
     format8,
     open_rpc)
+from commitment_util import CommitmentVerifier
 
 
 MAX_MONEY = 21000000 * COIN
@@ -682,6 +683,7 @@ def main():
     zero_value_ctos = 0
     if 'knowninfodir' in settings:
         knowninfodir = settings['knowninfodir']
+        verifier = CommitmentVerifier()
         files = os.listdir(knowninfodir)
         for f in files:
             if os.path.isdir(os.path.join(knowninfodir, f)):
@@ -746,12 +748,9 @@ def main():
 
                             source_tx = chain_stats.callrpc('getrawtransaction', [txid, True])
                             value_commitment = source_tx['vout'][vout]['valueCommitment']
-                            try:
-                                verify_rv = chain_stats.callrpc('verifycommitment', [value_commitment, split[3], format8(ctv)])
-                            except Exception as e:
+                            if not verifier.verify(value_commitment, split[3], ctv):
                                 print('verifycommitment failed', txid, vout, value_commitment, split[3], format8(ctv))
                                 continue
-                            assert(verify_rv['result'] is True)
                             chain_stats.value_ctos[Prevout(txid, vout)] = ctv
                             if ctv == 0:
                                 zero_value_ctos += 1
@@ -781,12 +780,9 @@ def main():
                             if split[3] == '0000000000000000000000000000000000000000000000000000000000000000':
                                 logging.info('Warning value_aos with null blinding factor from: {}'.format(f))
                             else:
-                                try:
-                                    verify_rv = chain_stats.callrpc('verifycommitment', [value_commitment, split[3], format8(aov)])
-                                except Exception as e:
+                                if not verifier.verify(value_commitment, split[3], aov):
                                     logging.info('verifycommitment failed {}, {}, {}'.format(value_commitment, split[3], format8(aov)))
-                                    raise(e)
-                                assert(verify_rv['result'] is True)
+                                    raise ValueError('verifycommitment failed')
 
                         if aoi in chain_stats.value_aos:
                             #logging.info('Duplicate aov: {}'.format(aoi))
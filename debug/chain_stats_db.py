@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2022 tecnovert
+# Distributed under the MIT software license, see the accompanying
+# file LICENSE or http://www.opensource.org/licenses/mit-license.php.
+
+"""
+Queries against the chain_stats.db written by anon_stats_sqlite.py.
+Statements are parameterized with constant sql text, so sqlite3 reuses the
+compiled statements from its cache.
+"""
+
+import sqlite3
+import urllib.parse
+
+
+class ChainStatsDB():
+    def __init__(self, db_path):
+        # mode=rw fails if the db doesn't exist instead of creating an empty one
+        self.dbc = sqlite3.connect('file:{}?mode=rw'.format(urllib.parse.quote(db_path)), uri=True)
+
+        # Covering indexes for the lookups below, the outputs table is created without any
+        self.dbc.execute('CREATE INDEX IF NOT EXISTS outputs_txid_n ON outputs (txid, n, value, is_estimate, spent_txid)')
+        self.dbc.execute('CREATE INDEX IF NOT EXISTS outputs_anon_index ON outputs (anon_index, value, is_estimate, spent_txid)')
+        self.dbc.execute('CREATE TEMP TABLE IF NOT EXISTS query_outputs (txid TEXT, n INTEGER)')
+        self.dbc.commit()
+
+    def close(self):
+        self.dbc.close()
+
+    def get_output(self, txid, n):
+        """Returns (value, is_estimate, spent_txid) for output n of txid, None if not found."""
+        return self.dbc.execute('SELECT value, is_estimate, spent_txid FROM outputs WHERE txid = ? AND n = ?', (txid, n)).fetchone()
+
+    def get_outputs(self, prevouts):
+        """Bulk get_output, returns a dict of (txid, n) -> (value, is_estimate, spent_txid) for the prevouts found."""
+        self.dbc.execute('DELETE FROM query_outputs')
+        self.dbc.executemany('INSERT INTO query_outputs (txid, n) VALUES (?, ?)', prevouts)
+        q = self.dbc.execute('''SELECT q.txid, q.n, o.value, o.is_estimate, o.spent_txid FROM query_outputs q
+                                JOIN outputs o ON o.txid = q.txid AND o.n = q.n''')
+        rv = {}
+        for txid, n, value, is_estimate, spent_txid in q:
+            rv[(txid, n)] = (value, is_estimate, spent_txid)
+        self.dbc.execute('DELETE FROM query_outputs')
+        return rv
+
+    def get_anon_outputs(self, anon_indices):
+        """Returns a dict of anon_index -> (value, is_estimate, spent_txid)."""
+        rv = {}
+        anon_indices = list(anon_indices)
+        # Stay under the default sqlite variable limit
+        for i in range(0, len(anon_indices), 500):
+            chunk = anon_indices[i: i + 500]
+            q = self.dbc.execute('SELECT anon_index, value, is_estimate, spent_txid FROM outputs WHERE anon_index IN ({})'.format(','.join(['?'] * len(chunk))), chunk)
+            for anon_index, value, is_estimate, spent_txid in q:
+                rv[anon_index] = (value, is_estimate, spent_txid)
+        return rv
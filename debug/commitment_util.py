@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2022 tecnovert
+# Distributed under the MIT software license, see the accompanying
+# file LICENSE or http://www.opensource.org/licenses/mit-license.php.
+
+"""
+Offline Pedersen commitment verification.
+
+A value commitment is C = blind * G + value * H, where H is the generator
+hashToCurve(ToDER(G)) and C is serialised as pointToCPK2 does.
+Points are kept as jacobian (X, Y, Z) int tuples, multiplication uses
+the fixed base tables of G and H from ecc_util.
+
+$ python commitment_util.py
+
+"""
+
+import time
+
+from ecc_util import ep, G, H, JACOBIAN_INFINITY, batchToAffine, pointToCPK2, getInsecureInt
+
+
+MAX_VALUE_BITS = 64  # Values are uint64
+
+
+def serialiseCommitment(x, y):
+    # Same as pointToCPK2, 0x08 if y is a quadratic residue else 0x09
+    ind = 0x08 if pow(y, (ep.p - 1) // 2, ep.p) == 1 else 0x09
+    return bytes((ind,)) + x.to_bytes(32, byteorder='big')
+
+
+class CommitmentVerifier():
+    def __init__(self):
+        self.H = H
+        self.g_table = G.getTable()
+        self.h_table = H.getTable()
+
+    def commitJacobian(self, blind, value):
+        return self.h_table.mulJacobian(value, self.g_table.mulJacobian(blind))
+
+    def commit(self, blind, value):
+        """Returns the serialised commitment to value, None if the inputs are invalid."""
+        return self.commitBatch([(blind, value)])[0]
+
+    def commitBatch(self, pairs):
+        points = []
+        for blind, value in pairs:
+            if blind >= ep.o or value < 0 or value >> MAX_VALUE_BITS:
+                points.append(JACOBIAN_INFINITY)
+            else:
+                points.append(self.commitJacobian(blind, value))
+        return [None if pt is None else serialiseCommitment(*pt) for pt in batchToAffine(points)]
+
+    def verify(self, commitment, blind, value):
+        """Check a hex commitment against a hex blinding factor and an int value."""
+        return self.verifyBatch([(commitment, blind, value)])[0]
+
+    def verifyBatch(self, triples):
+        """Verify (commitment, blind, value) triples, returns a list of bools."""
+        pairs = []
+        for commitment, blind, value in triples:
+            try:
+                blind_bytes = bytes.fromhex(blind)
+            except ValueError:
+                blind_bytes = b''
+            # Invalid blinding factors fail like the rpc
+            pairs.append((int.from_bytes(blind_bytes, byteorder='big') if len(blind_bytes) == 32 else ep.o, value))
+        rv = []
+        for (commitment, blind, value), c in zip(triples, self.commitBatch(pairs)):
+            rv.append(c is not None and c.hex() == commitment.lower())
+        return rv
+
+
+def testCommitmentUtil():
+    print('testCommitmentUtil()')
+
+    verifier = CommitmentVerifier()
+    H = verifier.H
+    for value in (0, 1, 15, 16, 123456789, 21000000 * 100000000, (1 << 64) - 1):
+        blind = getInsecureInt()
+        expect = pointToCPK2(G * blind + H * value)
+        assert(verifier.commit(blind, value) == expect)
+
+        triple = (expect.hex(), blind.to_bytes(32, byteorder='big').hex(), value)
+        assert(verifier.verifyBatch([triple, (triple[0], triple[1], value + 1)]) == [True, False])
+    assert(verifier.commit(ep.o, 1) is None)
+    assert(verifier.commit(0, 1 << 64) is None)
+    assert(verifier.verify('08' + '00' * 32, 'zz', 1) is False)
+
+    num_commitments = 1000
+    triples = []
+    for i in range(num_commitments):
+        blind = getInsecureInt()
+        triples.append((None, blind.to_bytes(32, byteorder='big').hex(), i))
+    t = time.time()
+    commitments = verifier.commitBatch([(int(blind, 16), value) for _, blind, value in triples])
+    triples = [(c.hex(), blind, value) for c, (_, blind, value) in zip(commitments, triples)]
+    assert(all(verifier.verifyBatch(triples)))
+    print('Verified {} commitments in {:.3f}s'.format(num_commitments, time.time() - t))
+
+    print('Passed.')
+
+
+if __name__ == '__main__':
+    testCommitmentUtil()
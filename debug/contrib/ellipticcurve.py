@@ -53,6 +53,59 @@ def inverse_mod(a, m):
     else: return ud + m
 
 
+# Jacobian coordinates (X, Y, Z) represent the affine point (X / Z^2, Y / Z^3),
+# Z == 0 is the point at infinity.
+JACOBIAN_INFINITY = (0, 1, 0)
+
+
+def jacobian_double(X1, Y1, Z1, a, p):
+    """Double a jacobian point on y^2 = x^3 + a*x + b (mod p)."""
+    if Z1 == 0 or Y1 == 0:
+        return JACOBIAN_INFINITY
+    YY = Y1 * Y1 % p
+    S = 4 * X1 * YY % p
+    M = 3 * X1 * X1
+    if a:
+        ZZ = Z1 * Z1 % p
+        M += a * ZZ * ZZ
+    M %= p
+    X3 = (M * M - 2 * S) % p
+    Y3 = (M * (S - X3) - 8 * YY * YY) % p
+    Z3 = 2 * Y1 * Z1 % p
+    return (X3, Y3, Z3)
+
+
+def jacobian_add_affine(X1, Y1, Z1, x2, y2, a, p):
+    """Add the affine point (x2, y2) to a jacobian point."""
+    if Z1 == 0:
+        return (x2, y2, 1)
+    Z1Z1 = Z1 * Z1 % p
+    U2 = x2 * Z1Z1 % p
+    S2 = y2 * Z1 * Z1Z1 % p
+    H = (U2 - X1) % p
+    R = (S2 - Y1) % p
+    if H == 0:
+        if R == 0:
+            return jacobian_double(X1, Y1, Z1, a, p)
+        return JACOBIAN_INFINITY
+    HH = H * H % p
+    HHH = H * HH % p
+    V = X1 * HH % p
+    X3 = (R * R - HHH - 2 * V) % p
+    Y3 = (R * (V - X3) - Y1 * HHH) % p
+    Z3 = Z1 * H % p
+    return (X3, Y3, Z3)
+
+
+def jacobian_to_affine(X, Y, Z, p):
+    """Returns (x, y), None for infinity."""
+    if Z == 0:
+        return None
+    z_inv = inverse_mod(Z, p)
+    z_inv2 = z_inv * z_inv % p
+    return (X * z_inv2 % p, Y * z_inv2 * z_inv % p)
+
+
 def modular_sqrt(a, p):
     """
     http://eli.thegreenplace.net/2009/03/07/computing-modular-square-roots-in-python/
@@ -199,14 +252,19 @@ class Point(object):
     """ A point on an elliptic curve. Altering x and y is forbidding,
         but they can be read by the x() and y() methods."""
     def __init__(self, curve, x, y, order=None):
-        """curve, x, y, order; order (optional) is the order of this point."""
+        """curve, x, y, order; order (optional) is the order of this point.
+
+        Passing order costs a full multiplication to check it, without order
+        only the curve equation is checked."""
         self.__curve = curve
         self.__x = x
         self.__y = y
-        self.__order = order
+        # Set after the check, __mul__ would reduce order mod itself
+        self.__order = None
         # self.curve is allowed to be None only for INFINITY:
         if self.__curve: assert self.__curve.contains_point(x, y)
         if order: assert self * order == INFINITY
+        self.__order = order
 
     def __eq__(self, other):
         """Return 1 if the points are identical, 0 otherwise."""
@@ -258,7 +316,7 @@ class Point(object):
             if (self.__y + opi) % self.__curve.p() == 0:
                 return INFINITY
             else:
-                return self.double
+                return self.double()
 
         l = ((opi - self.__y) * inverse_mod(other.__x - self.__x, p)) % p
 
@@ -270,11 +328,20 @@ class Point(object):
     def __mul__(self, e):
         if self.__order: e %= self.__order
         if e == 0 or self == INFINITY: return INFINITY
-        result, q = INFINITY, self
-        while e:
-            if e & 1: result += q
-            e, q = e >> 1, q.double()
-        return result
+        if e < 0: return self.inverse() * -e
+
+        # Double and add in jacobian coordinates, a single inversion at the end
+        p = self.__curve.p()
+        a = self.__curve.a()
+        x, y = self.__x, self.__y
+        X, Y, Z = JACOBIAN_INFINITY
+        for bit in bin(e)[2:]:
+            X, Y, Z = jacobian_double(X, Y, Z, a, p)
+            if bit == '1':
+                X, Y, Z = jacobian_add_affine(X, Y, Z, x, y, a, p)
+        result = jacobian_to_affine(X, Y, Z, p)
+        if result is None: return INFINITY
+        return Point(self.__curve, result[0], result[1])
 
     def __rmul__(self, other):
         """Multiply a point by an integer."""
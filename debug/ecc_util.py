@@ -2,11 +2,21 @@
 # -*- coding: utf-8 -*-
 
 import os
+import time
 import codecs
 import hashlib
 import secrets
 
-from contrib.ellipticcurve import CurveFp, Point, jacobi_symbol
+from contrib.ellipticcurve import (
+    CurveFp, Point, INFINITY, JACOBIAN_INFINITY, jacobi_symbol,
+    jacobian_double, jacobian_add_affine, jacobian_to_affine,
+)
+
+
+# Optional directory to store the fixed base tables in, building them takes a moment
+fixed_base_cache_dir = os.path.expanduser(os.getenv('FIXED_BASE_CACHE_DIR', ''))
+FIXED_BASE_WINDOW_BITS = 8
+WNAF_WINDOW_BITS = 5
 
 
 class ECCParameters():
@@ -29,7 +39,6 @@ ep = ECCParameters( \
 
 
 curve_secp256k1 = CurveFp(ep.p, ep.a, ep.b)
-G = Point(curve_secp256k1, ep.Gx, ep.Gy, ep.o)
 
 SECP256K1_ORDER_HALF = ep.o // 2
 
@@ -89,21 +98,17 @@ def validKey(i):
 
 def powMod(x, y, z):
     # Calculate (x ** y) % z efficiently.
-    number = 1
-    while y:
-        if y & 1:
-            number = number * x % z
-        y >>= 1  # y //= 2
-
-        x = x * x % z
-    return number
+    return pow(x, y, z)
 
 
 def ToDER(P):
     return bytes((4, )) + int(P.x()).to_bytes(32, byteorder='big') + int(P.y()).to_bytes(32, byteorder='big')
 
 
-def CPKToPoint(cpk):
+def CPKToPoint(cpk, check_order=False):
+    # Only the curve equation is checked unless check_order is set.
+    # secp256k1 has cofactor 1, every point on the curve has order ep.o,
+    # check_order is for untrusted input where the extra multiplication doesn't matter.
     y_parity = cpk[0] - 2
 
     x = int.from_bytes(cpk[1:], byteorder='big')
@@ -113,7 +118,7 @@ def CPKToPoint(cpk):
     if y % 2 != y_parity:
         y = ep.p - y
 
-    return Point(curve_secp256k1, x, y, ep.o)
+    return Point(curve_secp256k1, x, y, ep.o if check_order else None)
 
 
 def pointToCPK2(point, ind=0x09):
@@ -141,16 +146,224 @@ def hashToCurve(pubkey):
 
         if y % 2 != y_parity:
             y = ep.p - y
-        try:
-            point = Point(curve_secp256k1, x, y, ep.o)
-            return point
-        except Exception:
-            xBytes = hashlib.sha256(xBytes).digest()
-            x = int.from_bytes(xBytes, byteorder='big')
+        if y * y % ep.p == a:
+            return Point(curve_secp256k1, x, y)
+        xBytes = hashlib.sha256(xBytes).digest()
+        x = int.from_bytes(xBytes, byteorder='big')
 
     raise ValueError('hashToCurve failed for 100 tries')
 
 
+def batchToAffine(points):
+    """Convert jacobian points to affine (x, y) with a single field inversion, infinity becomes None."""
+    p = ep.p
+    prefix = []
+    acc = 1
+    for X, Y, Z in points:
+        prefix.append(acc)
+        if Z != 0:
+            acc = acc * Z % p
+
+    inv = pow(acc, -1, p)
+    rv = [None] * len(points)
+    for i in range(len(points) - 1, -1, -1):
+        X, Y, Z = points[i]
+        if Z == 0:
+            continue
+        z_inv = inv * prefix[i] % p
+        inv = inv * Z % p
+        z_inv2 = z_inv * z_inv % p
+        rv[i] = (X * z_inv2 % p, Y * z_inv2 * z_inv % p)
+    return rv
+
+
+class FixedBaseTable():
+    """d * 2^(window_bits * i) * P for every window i and digit d, stored affine."""
+    def __init__(self, windows, window_bits):
+        self.windows = windows
+        self.window_bits = window_bits
+
+    @classmethod
+    def build(cls, x, y, num_bits=256, window_bits=FIXED_BASE_WINDOW_BITS):
+        window_size = 1 << window_bits
+        windows = []
+        base = (x, y)
+        for i in range((num_bits + window_bits - 1) // window_bits):
+            multiples = [(base[0], base[1], 1)]
+            for d in range(2, window_size):
+                multiples.append(jacobian_add_affine(*multiples[-1], *base, 0, ep.p))
+            multiples.append(jacobian_double(*multiples[window_size // 2 - 1], 0, ep.p))
+            affine = batchToAffine(multiples)
+            windows.append(affine[:-1])
+            base = affine[-1]
+        return cls(windows, window_bits)
+
+    @classmethod
+    def load(cls, file_path, x, y, num_bits=256, window_bits=FIXED_BASE_WINDOW_BITS):
+        """Returns None if the file doesn't hold a table for (x, y) of this shape.
+
+        The entries must match the sha256 digest stored after them, and the first
+        entry of each window must be the double of digit 2^(window_bits - 1) in the
+        previous window.
+        """
+        window_size = 1 << window_bits
+        num_windows = (num_bits + window_bits - 1) // window_bits
+        with open(file_path, 'rb') as fp:
+            data = fp.read()
+        if len(data) != num_windows * (window_size - 1) * 64 + 32:
+            return None
+        if hashlib.sha256(data[:-32]).digest() != data[-32:]:
+            return None
+        windows = []
+        o = 0
+        for i in range(num_windows):
+            window = []
+            for d in range(1, window_size):
+                px = int.from_bytes(data[o: o + 32], byteorder='big')
+                py = int.from_bytes(data[o + 32: o + 64], byteorder='big')
+                o += 64
+                if not curve_secp256k1.contains_point(px, py):
+                    return None
+                window.append((px, py))
+            windows.append(window)
+        if windows[0][0] != (x, y):
+            return None
+        for i in range(1, num_windows):
+            # Compare in jacobian coordinates, X = x * Z^2 and Y = y * Z^3
+            X, Y, Z = jacobian_double(*windows[i - 1][window_size // 2 - 1], 1, 0, ep.p)
+            bx, by = windows[i][0]
+            if (bx * Z * Z - X) % ep.p != 0 or (by * Z * Z * Z - Y) % ep.p != 0:
+                return None
+        return cls(windows, window_bits)
+
+    def save(self, file_path):
+        # Write to a temporary file and move it into place, a reader never sees a partial table
+        data = b''.join(px.to_bytes(32, byteorder='big') + py.to_bytes(32, byteorder='big') for window in self.windows for px, py in window)
+        tmp_path = '{}.{}.tmp'.format(file_path, os.getpid())
+        with open(tmp_path, 'wb') as fp:
+            fp.write(data + hashlib.sha256(data).digest())
+        os.replace(tmp_path, file_path)
+
+    def mulJacobian(self, k, R=JACOBIAN_INFINITY):
+        """Returns R + k * P as a jacobian point, k must fit in the table."""
+        mask = (1 << self.window_bits) - 1
+        for window in self.windows:
+            if k == 0:
+                break
+            d = k & mask
+            if d:
+                R = jacobian_add_affine(*R, *window[d - 1], 0, ep.p)
+            k >>= self.window_bits
+        return R
+
+
+class FixedBasePoint(Point):
+    """A generator multiplied with a FixedBaseTable, the table is built or loaded on first use."""
+    def __init__(self, point, name):
+        # point must already be validated, its order is ep.o
+        super().__init__(curve_secp256k1, point.x(), point.y())
+        self.name = name
+        self.table = None
+
+    def getTable(self):
+        if self.table is not None:
+            return self.table
+        cache_path = None
+        if fixed_base_cache_dir != '':
+            cache_path = os.path.join(fixed_base_cache_dir, 'fixed_base_{}_{}.bin'.format(self.name, FIXED_BASE_WINDOW_BITS))
+            if os.path.exists(cache_path):
+                self.table = FixedBaseTable.load(cache_path, self.x(), self.y())
+        if self.table is None:
+            self.table = FixedBaseTable.build(self.x(), self.y())
+            if cache_path is not None:
+                self.table.save(cache_path)
+        return self.table
+
+    def __mul__(self, e):
+        e %= ep.o
+        if e == 0:
+            return INFINITY
+        rv = jacobian_to_affine(*self.getTable().mulJacobian(e), ep.p)
+        if rv is None:
+            return INFINITY
+        return Point(curve_secp256k1, rv[0], rv[1])
+
+
+def wNAF(k, w=WNAF_WINDOW_BITS):
+    """Width w non-adjacent form of k, least significant digit first, digits are odd or 0."""
+    digits = []
+    while k:
+        if k & 1:
+            d = k & ((1 << w) - 1)
+            if d >= 1 << (w - 1):
+                d -= 1 << w
+            k -= d
+        else:
+            d = 0
+        digits.append(d)
+        k >>= 1
+    return digits
+
+
+def multiScalarMul(pairs):
+    """Returns the sum of k * P for (k, P) pairs.
+
+    Variable base points share the doublings of an interleaved wNAF (Strauss)
+    multiplication, FixedBasePoints are added from their tables afterwards.
+    """
+    fixed = []
+    nafs = []
+    jacobian_tables = []
+    half = 1 << (WNAF_WINDOW_BITS - 1)
+    for k, P in pairs:
+        k %= ep.o
+        if k == 0 or P == INFINITY:
+            continue
+        if isinstance(P, FixedBasePoint):
+            fixed.append((k, P))
+            continue
+        # 1P, 3P, 5P .. (2^(w-1) - 1)P
+        x, y = P.x(), P.y()
+        multiples = [(x, y, 1)]
+        for i in range(2, half):
+            multiples.append(jacobian_add_affine(*multiples[-1], x, y, 0, ep.p))
+        jacobian_tables.append(multiples[::2])
+        nafs.append(wNAF(k))
+
+    # One inversion for all the tables
+    affine = batchToAffine([pt for table in jacobian_tables for pt in table])
+    tables = []
+    for table in jacobian_tables:
+        tables.append(affine[:len(table)])
+        affine = affine[len(table):]
+
+    R = JACOBIAN_INFINITY
+    for i in range(max((len(naf) for naf in nafs), default=0) - 1, -1, -1):
+        R = jacobian_double(*R, 0, ep.p)
+        for naf, table in zip(nafs, tables):
+            if i >= len(naf) or naf[i] == 0:
+                continue
+            d = naf[i]
+            if d > 0:
+                R = jacobian_add_affine(*R, *table[d >> 1], 0, ep.p)
+            else:
+                px, py = table[-d >> 1]
+                R = jacobian_add_affine(*R, px, ep.p - py, 0, ep.p)
+
+    for k, P in fixed:
+        R = P.getTable().mulJacobian(k, R)
+
+    rv = jacobian_to_affine(*R, ep.p)
+    if rv is None:
+        return INFINITY
+    return Point(curve_secp256k1, rv[0], rv[1])
+
+
+G = FixedBasePoint(Point(curve_secp256k1, ep.Gx, ep.Gy, ep.o), 'G')
+# Pedersen commitment value generator
+H = FixedBasePoint(hashToCurve(ToDER(G)), 'H')
+
+
 i2b = intToBytes32
 b2i = bytes32ToInt
 b2h = bytesToHexStr
@@ -165,6 +378,16 @@ def h2i(x):
     return h2b(b2i(x))
 
 
+def mulAffine(P, k):
+    # Reference double and add in affine coordinates, an inversion per step
+    result, q = INFINITY, P
+    while k:
+        if k & 1:
+            result += q
+        k, q = k >> 1, q.double()
+    return result
+
+
 def testEccUtils():
     print('testEccUtils()')
 
@@ -175,15 +398,96 @@ def testEccUtils():
     assert(G_enc.hex() == '0279be667ef9dcbbac55a06295ce870b07029bfcdb2dce28d959f2815b16f81798')
     G_dec = CPKToPoint(G_enc)
     assert(G_dec == G)
+    assert(CPKToPoint(G_enc, check_order=True) == G)
+    try:
+        Point(curve_secp256k1, ep.Gx, ep.Gy, ep.o - 1)
+        assert(False)
+    except AssertionError as e:
+        assert(str(e) == '')
 
     G_enc = pointToCPK2(G)
     assert(G_enc.hex() == '0879be667ef9dcbbac55a06295ce870b07029bfcdb2dce28d959f2815b16f81798')
 
-    H = hashToCurve(ToDER(G))
+    assert(hashToCurve(ToDER(G)) == H)
     assert(pointToCPK(H).hex() == '0250929b74c1a04954b78b4b6035e97a5e078a5a0f28ec96d547bfee9ace803ac0')
 
+    P = INFINITY
+    for k in range(1, 20):
+        P += G
+        assert(G * k == P)
+        assert(H * k == mulAffine(H, k))
+    assert(G * ep.o == INFINITY)
+    assert(G * 0 == INFINITY)
+    assert(G * (ep.o - 1) == G.inverse())
+    assert(G * -1 == G.inverse())
+    assert(H * (ep.o + 3) == mulAffine(H, 3))
+    for i in range(4):
+        k = getInsecureInt()
+        assert(G * k == mulAffine(G, k))
+        assert(H * k == mulAffine(H, k))
+        assert(G * k == Point.__mul__(G, k))
+
+    for k in (0, 1, 15, 16, 17, -1, 1 << 255, ep.o - 1, getInsecureInt()):
+        naf = wNAF(k % ep.o)
+        assert(sum(d << i for i, d in enumerate(naf)) == k % ep.o)
+        assert(all(d == 0 or (d & 1 and abs(d) < 1 << (WNAF_WINDOW_BITS - 1)) for d in naf))
+
+    P = G * getInsecureInt()
+    Q = H * getInsecureInt()
+    for i in range(4):
+        a, b, c = getInsecureInt(), getInsecureInt(), getInsecureInt()
+        assert(multiScalarMul([(a, P), (b, Q)]) == mulAffine(P, a) + mulAffine(Q, b))
+        assert(multiScalarMul([(a, G), (b, P), (c, Q)]) == G * a + P * b + Q * c)
+    assert(multiScalarMul([(1, P), (ep.o - 1, P)]) == INFINITY)
+    assert(multiScalarMul([(2, P), (ep.o - 1, P)]) == P)
+    assert(multiScalarMul([(1, P), (1, P)]) == P.double())
+    assert(multiScalarMul([(3, INFINITY), (0, P), (5, G)]) == G * 5)
+    assert(multiScalarMul([]) == INFINITY)
+
     print('Passed.')
 
 
+def benchmarkScalarMul(num_mults=100):
+    print('benchmarkScalarMul()')
+
+    scalars = [getInsecureInt() for i in range(num_mults)]
+    G.table = None
+    t = time.time()
+    G.getTable()
+    t_table = time.time() - t
+
+    t = time.time()
+    points = [G * k for k in scalars]
+    t_fixed = time.time() - t
+
+    t = time.time()
+    expect = [Point.__mul__(G, k) for k in scalars]
+    t_mul = time.time() - t
+    assert(points == expect)
+
+    t = time.time()
+    expect = [mulAffine(G, k) for k in scalars]
+    t_affine = time.time() - t
+    assert(points == expect)
+
+    print('G * k, {} multiplications: {:.3f}ms each, {} bit fixed base table ready in {:.3f}s'.format(
+          num_mults, t_fixed * 1000 / num_mults, FIXED_BASE_WINDOW_BITS, t_table))
+    print('  variable base {:.3f}ms each, affine reference {:.3f}ms each'.format(
+          t_mul * 1000 / num_mults, t_affine * 1000 / num_mults))
+
+    P = G * getInsecureInt()
+    Q = G * getInsecureInt()
+    t = time.time()
+    sums = [multiScalarMul([(k, P), (k + 1, Q)]) for k in scalars]
+    t_msm = time.time() - t
+    t = time.time()
+    expect = [P * k + Q * (k + 1) for k in scalars]
+    t_separate = time.time() - t
+    assert(sums == expect)
+    print('a * P + b * Q: {:.3f}ms each, separately {:.3f}ms each'.format(
+          t_msm * 1000 / num_mults, t_separate * 1000 / num_mults))
+
+
 if __name__ == '__main__':
     testEccUtils()
+    benchmarkScalarMul()
@@ -16,42 +16,44 @@ $ python find_external_sends.py ~/anons_wallet1.txt ~/anons_wallet2.txt
 
 import os
 import sys
-import json
+from util import stream_json_items, make_int, format8
 
 
 def main():
 
-    json_inputs = []
-    for i in range(1, len(sys.argv)):
-        with open(os.path.expanduser(sys.argv[i])) as fp:
-            json_inputs.append(json.load(fp))
+    # Files are streamed twice instead of being held in memory
+    input_files = [os.path.expanduser(arg) for arg in sys.argv[1:]]
 
-    # Find all received txns
+    # Build txid -> {wallet: net amount received} from the receive records
     received_outputs = {}
-    for i, json_input in enumerate(json_inputs):
-        for tx in json_input:
-            if tx['category'] == 'receive':
-                for output in tx['outputs']:
-                    received_outputs[tx['txid']] = (i, tx)
+    for i, input_file in enumerate(input_files):
+        for document_index, key, tx in stream_json_items(input_file):
+            if tx['category'] == 'receive' and len(tx['outputs']) > 0:
+                received_by = received_outputs.setdefault(tx['txid'], {})
+                received_by[i] = received_by.get(i, 0) + make_int(tx['amount'])
 
-    # Test all sent txns
+    # Match the send records against the received table
     num_sent = 0
-    for i, json_input in enumerate(json_inputs):
-        for tx in json_input:
+    wallet_pairs = {}  # (from, to) -> [num_txns, amount], to is None for external sends
+
+    def add_to_pair(pair, amount):
+        pair_totals = wallet_pairs.setdefault(pair, [0, 0])
+        pair_totals[0] += 1
+        pair_totals[1] += amount
+
+    for i, input_file in enumerate(input_files):
+        for document_index, key, tx in stream_json_items(input_file):
             if tx['category'] == 'send':
                 num_sent += 1
-                partial_receive = False
-                if tx['txid'] in received_outputs:
-                    #print('sent from', i)
+                sent_amount = -make_int(tx['amount'])
+                received_by = received_outputs.get(tx['txid'], {})
+                for recv_offset, recv_amount in received_by.items():
+                    add_to_pair((i, recv_offset), recv_amount)
 
-                    recv_offset, recv_tx = received_outputs[tx['txid']]
-                    #print('sent to', recv_offset)
-                    #print('sent tx', json.dumps(tx, indent=4))
-                    #print('recv tx', json.dumps(recv_tx, indent=4))
-
-                    if tx['amount'] + recv_tx['amount'] == 0:
-                        continue
-                    partial_receive = True
+                external_amount = sent_amount - sum(received_by.values())
+                if external_amount == 0:
+                    continue
+                add_to_pair((i, None), external_amount)
 
                 print(tx['txid'], tx['amount'])
                 #print('sent tx', json.dumps(tx, indent=4))
@@ -59,6 +61,11 @@ def main():
     print('num_received', len(received_outputs))
     print('num_sent', num_sent)
 
+    print('\nWallet pairs:')
+    for (from_offset, to_offset), (num_txns, amount) in sorted(wallet_pairs.items(), key=lambda x: (x[0][0], -1 if x[0][1] is None else x[0][1])):
+        to_name = 'external' if to_offset is None else input_files[to_offset]
+        print('{} -> {}: {} txns, {}'.format(input_files[from_offset], to_name, num_txns, format8(amount)))
+
 
 if __name__ == '__main__':
     main()
@@ -10,6 +10,14 @@ $ export BIN_PATH=~/tmp/particl-0.21.2.11/bin
 $ ${BIN_PATH}/particl-qt -server
 $ python find_inputs.py datadir addr
 
+Trace from an address history index instead of walking the whole chain,
+the index is created or updated before tracing:
+$ ADDRESS_INDEX_FILE=~/address_index.db python find_inputs.py datadir addr
+
+Inputs are traced breadth first up to max_dist_from_main hops from the
+main address, the parent txns of each hop are fetched in concurrent
+batches.
+
 
 TODO: graphs
 
@@ -17,10 +25,15 @@ TODO: graphs
 
 import os
 import sys
-import json
 import time
 import sqlite3
-from util import callrpc, format8
+import collections
+import concurrent.futures
+from util import callrpc, callrpc_batch, format8
+from address_index import AddressIndex
+
+address_index_file_in = os.getenv('ADDRESS_INDEX_FILE', '')
+address_index_file = os.path.expanduser(address_index_file_in)
 
 
 class FindAddress():
@@ -31,11 +44,53 @@ class FindAddress():
         self.dist_from_main = dist_from_main
 
 
+class Prevout():
+    __slots__ = ('txid', 'n')
+
+    def __init__(self, txid, n):
+        self.txid = txid
+        self.n = int(n)
+
+    def __hash__(self):
+        return hash((self.txid, self.n))
+
+    def __eq__(self, other):
+        if not isinstance(other, type(self)):
+            return NotImplemented
+        return self.txid == other.txid and self.n == other.n
+
+
+class TxOut():
+    __slots__ = ('type', 'addresses', 'value', 'script', 'script_type')
+
+    def __init__(self, txo):
+        self.type = txo['type']
+        spk = txo.get('scriptPubKey', {})
+        self.addresses = tuple(spk.get('addresses', ()))
+        self.value = txo.get('valueSat', 0)
+        self.script = spk.get('hex', '')
+        self.script_type = spk.get('type', '')
+
+
 class InputTxn():
+    """Keeps only the fields of a txn the report needs.
+
+    vin entries are a Prevout, or 'coinbase' or 'anon'.
+    """
+    __slots__ = ('height', 'blockhash', 'vin', 'vout')
+
     def __init__(self, tx, height, blockhash):
-        self.tx = tx
         self.height = height
         self.blockhash = blockhash
+        self.vin = []
+        for txin in tx['vin']:
+            if 'coinbase' in txin:
+                self.vin.append('coinbase')
+            elif 'type' in txin and txin['type'] == 'anon':
+                self.vin.append('anon')
+            else:
+                self.vin.append(Prevout(txin['txid'], txin['vout']))
+        self.vout = [TxOut(txo) for txo in tx['vout']]
 
 
 class AddressInput():
@@ -54,25 +109,12 @@ class AddressInput():
         self.num_txns += 1
 
 
-class Prevout():
-    __slots__ = ('txid', 'n')
-
-    def __init__(self, txid, n):
-        self.txid = txid
-        self.n = int(n)
-
-    def __hash__(self):
-        return hash((self.txid, self.n))
-
-    def __eq__(self, other):
-        if not isinstance(other, type(self)):
-            return NotImplemented
-        return self.txid == other.txid and self.n == other.n
-
-
 addrs = {}
 txns = {}
 linked_prevouts = set()
+# List of addreses in the order they are found
+addrs_seen = []
+addrs_seen_set = set()
 
 
 def make_rpc_func(rpc_port, rpc_auth, wallet=None):
@@ -83,14 +125,157 @@ def make_rpc_func(rpc_port, rpc_auth, wallet=None):
     def rpc_func(cmd, args=[], wallet_override=None):
         nonlocal rpc_port, rpc_auth, wallet
         return callrpc(rpc_port, rpc_auth, cmd, args, wallet if wallet_override is None else wallet_override)
+
+    def rpc_batch(calls, wallet_override=None):
+        nonlocal rpc_port, rpc_auth, wallet
+        return callrpc_batch(rpc_port, rpc_auth, calls, wallet if wallet_override is None else wallet_override)
+
+    rpc_func.batch = rpc_batch
     return rpc_func
 
 
+def add_found(txid, found_addresses):
+    for k in found_addresses:
+        if k not in addrs_seen_set:
+            addrs_seen.append(k)
+            addrs_seen_set.add(k)
+        addrs[k].txids_vout.add(txid)
+
+
+def fetch_txns(callrpcw, txids, num_workers, batch_size):
+    """Fetch txns missing from txns with concurrent batched getrawtransaction calls."""
+    txids = [txid for txid in set(txids) if txid not in txns]
+    batches = [txids[i: i + batch_size] for i in range(0, len(txids), batch_size)]
+
+    def fetch_batch(batch_txids):
+        return callrpcw.batch([('getrawtransaction', [txid, True]) for txid in batch_txids])
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=num_workers) as executor:
+        for batch_txids, batch_txns in zip(batches, executor.map(fetch_batch, batches)):
+            for txid, tx in zip(batch_txids, batch_txns):
+                txns[txid] = InputTxn(tx, tx['height'], tx['blockhash'])
+
+
+def walk_chain(callrpcw, block_hash, main_address):
+    """Walk back from block_hash to genesis collecting the txns paying main_address.
+
+    Also returns the number of outputs to each address, for count_skipped_prevouts_walked.
+    """
+    frontier = {}
+    output_counts = collections.Counter()
+    while True:
+        block_data = callrpcw('getblock', [block_hash, 2])
+
+        block_height = block_data['height']
+        for tx in block_data['tx']:
+            pays_main = False
+            for tx_out in tx['vout']:
+                if tx_out['type'] != 'standard':
+                    continue
+                if 'addresses' not in tx_out['scriptPubKey']:
+                    # "asm": "OP_RETURN",
+                    # prefork workaround for smsg/mp data output limits was to add an empty opreturn output
+                    continue
+                output_counts.update(tx_out['scriptPubKey']['addresses'])
+                if main_address in tx_out['scriptPubKey']['addresses']:
+                    pays_main = True
+            if pays_main:
+                frontier[tx['txid']] = ([main_address], 0)
+                txns[tx['txid']] = InputTxn(tx, block_height, block_hash)
+
+        if block_data['height'] % 10000 == 0:
+            print('height', block_data['height'], flush=True)
+            print('len(frontier)', len(frontier))
+
+        try:
+            block_hash = block_data['previousblockhash']
+        except Exception as e:
+            print('previousblockhash', e)
+            break
+    return frontier, output_counts
+
+
+def trace_inputs(callrpcw, frontier, max_dist_from_main, num_workers, batch_size):
+    """Breadth first trace from the txns in frontier, txid -> (found_addresses, min_dist_from_main).
+
+    The parent txns of each hop are fetched together before moving to the next hop.
+    """
+    fetch_txns(callrpcw, frontier.keys(), num_workers, batch_size)
+
+    traced = set()
+    hop = 0
+    while len(frontier) > 0:
+        links = []
+        for txid, (found_addresses, min_dist_from_main) in frontier.items():
+            add_found(txid, found_addresses)
+            if txid in traced:
+                continue
+            traced.add(txid)
+            for txin in txns[txid].vin:
+                if isinstance(txin, Prevout):
+                    links.append((txin, min_dist_from_main))
+
+        fetch_txns(callrpcw, [prevout.txid for prevout, min_dist_from_main in links], num_workers, batch_size)
+
+        next_frontier = {}
+        for prevout, min_dist_from_main in links:
+            linked_prevouts.add(prevout)
+            txo = txns[prevout.txid].vout[prevout.n]
+
+            prev_min_dist = 1000
+            for addr in txo.addresses:
+                if addr not in addrs:
+                    addrs[addr] = FindAddress(addr, min_dist_from_main + 1)
+                prev_min_dist = min(prev_min_dist, addrs[addr].dist_from_main)
+
+            if txo.type != 'standard' or len(txo.addresses) < 1 or prev_min_dist >= max_dist_from_main:
+                continue
+            if prevout.txid in next_frontier:
+                found_addresses, min_dist = next_frontier[prevout.txid]
+                found_addresses = found_addresses + [addr for addr in txo.addresses if addr not in found_addresses]
+                next_frontier[prevout.txid] = (found_addresses, min(min_dist, prev_min_dist))
+            else:
+                next_frontier[prevout.txid] = (list(txo.addresses), prev_min_dist)
+
+        hop += 1
+        print('hop', hop, 'linked txns', len(next_frontier), 'len(txns)', len(txns), flush=True)
+        frontier = next_frontier
+
+
+def count_skipped_prevouts(address_index):
+    """Count outputs to linked addresses that don't feed into the main address."""
+    prevouts_skipped = 0
+    for addr, addr_v in addrs.items():
+        if addr_v.dist_from_main == 0:
+            continue
+        for txid, n, height in address_index.get_outputs(addr):
+            if Prevout(txid, n) not in linked_prevouts:
+                prevouts_skipped += 1
+    return prevouts_skipped
+
+
+def count_skipped_prevouts_walked(output_counts):
+    """count_skipped_prevouts from the number of outputs to each address seen by walk_chain."""
+    linked_counts = collections.Counter()
+    for prevout in linked_prevouts:
+        txo = txns[prevout.txid].vout[prevout.n]
+        if txo.type == 'standard':
+            linked_counts.update(txo.addresses)
+    prevouts_skipped = 0
+    for addr, addr_v in addrs.items():
+        if addr_v.dist_from_main == 0:
+            continue
+        prevouts_skipped += output_counts[addr] - linked_counts[addr]
+    return prevouts_skipped
+
+
 def main():
     particl_data_dir = os.path.expanduser(sys.argv[1])
     main_address = os.path.expanduser(sys.argv[2])
 
     max_dist_from_main = 3
+    num_workers = 8
+    batch_size = 100
 
     # db_filepath = '/tmp/find_inputs.sqlite'
     db_filepath = 'find_inputs.sqlite'
@@ -128,87 +313,26 @@ def main():
 
     addrs[main_address] = FindAddress(main_address, 0)
 
-    # List of addreses in the (reverse) order they appear in the chain
-    addrs_seen = []
-    prevouts_skipped = 0
-
-    while True:
-        block_data = callrpcw('getblock', [block_hash, 2])
-
-        block_height = block_data['height']
-        for tx_i, tx in enumerate(block_data['tx']):
-            txid = tx['txid']
-            for tx_out in tx['vout']:
-
-                min_dist_from_main = 1000
-                found_addresses = []
-                try:
-                    if tx_out['type'] != 'standard':
-                        continue
-                    for k, addr_v in addrs.items():
-                        if 'addresses' not in tx_out['scriptPubKey']:
-                            # "asm": "OP_RETURN",
-                            # prefork workaround for smsg/mp data output limits was to add an empty opreturn output
-                            continue
-                        if k in tx_out['scriptPubKey']['addresses']:
-                            # Filter out prevouts that don't feed into the main address
-                            if addr_v.dist_from_main > 0:
-                                if Prevout(txid, tx_out['n']) not in linked_prevouts:
-                                    prevouts_skipped += 1
-                                    continue
-
-                            if addr_v.dist_from_main < min_dist_from_main:
-                                min_dist_from_main = addr_v.dist_from_main
-
-                            found_addresses.append(k)
-
-                except Exception as e:
-                    print('error tx_out', e)
-                    print('tx', json.dumps(tx, indent=4))
-
-                if min_dist_from_main >= max_dist_from_main:
-                    continue
-
-                if len(found_addresses) == 0:
-                    continue
-
-                for k in found_addresses:
-                    if k not in addrs_seen:
-                        addrs_seen.append(k)
-                    addr_v = addrs[k]
-                    addr_v.txids_vout.add(txid)
-
-                txns[txid] = InputTxn(tx, block_height, block_hash)
-
-                for txi_n, tx_input in enumerate(tx['vin']):
-                    if 'coinbase' in tx_input:
-                        break
-                    if 'type' in tx_input and tx_input['type'] == 'anon':
-                        continue
-
-                    prev_txid = tx_input['txid']
-                    prev_tx = callrpcw('getrawtransaction', [prev_txid, True])
-                    if prev_txid not in txns:
-                        txns[prev_txid] = InputTxn(prev_tx, prev_tx['height'], prev_tx['blockhash'])
-                    linked_prevouts.add(Prevout(prev_txid, tx_input['vout']))
-                    prevout = prev_tx['vout'][tx_input['vout']]
+    address_index = None
+    if address_index_file == '':
+        frontier, output_counts = walk_chain(callrpcw, block_hash, main_address)
+    else:
+        print('Address index path', address_index_file_in)
+        address_index = AddressIndex(address_index_file)
+        address_index.update(callrpcw)
+        frontier = {}
+        for txid, n, height in address_index.get_outputs(main_address):
+            frontier[txid] = ([main_address], 0)
 
-                    for addr in prevout['scriptPubKey']['addresses']:
-                        if addr not in addrs:
-                            addrs[addr] = FindAddress(addr, min_dist_from_main + 1)
-
-        if block_data['height'] % 10000 == 0:
-            print('height', block_data['height'], flush=True)
-            print('len(txns)', len(txns))
-
-        try:
-            block_hash = block_data['previousblockhash']
-        except Exception as e:
-            print('previousblockhash', e)
-            break
+    trace_inputs(callrpcw, frontier, max_dist_from_main, num_workers, batch_size)
 
     print('linked_prevouts', len(linked_prevouts))  # prevouts mapped to main_address
-    print('prevouts_skipped', prevouts_skipped)  # prevouts of addresses linked to main_address not connected in the txout history
+    # prevouts of addresses linked to main_address not connected in the txout history
+    if address_index is None:
+        print('prevouts_skipped', count_skipped_prevouts_walked(output_counts))
+    else:
+        print('prevouts_skipped', count_skipped_prevouts(address_index))
+        address_index.close()
     print('len(txns)', len(txns))
 
     total_coinbase_amount = 0
@@ -232,68 +356,57 @@ def main():
 
         for txid in addr_info.txids_vout:
             tx_obj = txns[txid]
-            tx = tx_obj.tx
             tx_height = tx_obj.height
             num_anon_inputs = 0
 
-            for txi_n, tx_input in enumerate(tx['vin']):
-                if 'coinbase' in tx_input:
+            for txi_n, tx_input in enumerate(tx_obj.vin):
+                if tx_input == 'coinbase':
                     coinbase_inputs.updateHeights(tx_height)
-                    for txo in tx['vout']:
-                        try:
-                            if addr in txo['scriptPubKey']['addresses']:
-                                coinbase_inputs.amount += txo['valueSat']
-
-                                c.execute('INSERT INTO outputs (txid, n, type, value, script, script_type, address, is_coinbase)  VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
-                                          (txid, txo['n'], 'P', txo['valueSat'], txo['scriptPubKey']['hex'], txo['scriptPubKey']['type'], ' '.join(txo['scriptPubKey']['addresses']), 1))
-
-                        except Exception as e:
-                            print('error tx vout', e)
-                            print('tx', json.dumps(tx, indent=4))
+                    for txo_n, txo in enumerate(tx_obj.vout):
+                        if addr in txo.addresses:
+                            coinbase_inputs.amount += txo.value
 
+                            c.execute('INSERT INTO outputs (txid, n, type, value, script, script_type, address, is_coinbase)  VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                                      (txid, txo_n, 'P', txo.value, txo.script, txo.script_type, ' '.join(txo.addresses), 1))
                     break
-                if 'type' in tx_input and tx_input['type'] == 'anon':
+                if tx_input == 'anon':
                     num_anon_inputs += 1
                     anon_input_txids.append(Prevout(txid, txi_n))
                     anon_inputs.updateHeights(tx_height)
                     continue
 
-                prev_tx_obj = txns[tx_input['txid']]
-                prev_tx = prev_tx_obj.tx
-
-                prevout = prev_tx['vout'][tx_input['vout']]
+                prevout = txns[tx_input.txid].vout[tx_input.n]
 
                 try:
                     update_addrs_plain = set()
                     update_addrs_blind = set()
-                    if prevout['type'] == 'blind':
-                        for addr in prevout['scriptPubKey']['addresses']:
-                            if addr not in blind_addrs_from:
-                                blind_addrs_from[addr] = AddressInput(addr, 0)
-                            update_addrs_blind.add(addr)
-                    elif tx_out['type'] == 'anon':
+                    if prevout.type == 'blind':
+                        for from_addr in prevout.addresses:
+                            if from_addr not in blind_addrs_from:
+                                blind_addrs_from[from_addr] = AddressInput(from_addr, 0)
+                            update_addrs_blind.add(from_addr)
+                    elif prevout.type == 'anon':
                         raise ValueError('Shouldn\'t happen')
                     else:
-                        for addr in prevout['scriptPubKey']['addresses']:
-                            if addr not in plain_addrs_from:
-                                plain_addrs_from[addr] = AddressInput(addr, prevout['valueSat'])
+                        for from_addr in prevout.addresses:
+                            if from_addr not in plain_addrs_from:
+                                plain_addrs_from[from_addr] = AddressInput(from_addr, prevout.value)
                             else:
-                                plain_addrs_from[addr].amount += prevout['valueSat']
-                            update_addrs_plain.add(addr)
+                                plain_addrs_from[from_addr].amount += prevout.value
+                            update_addrs_plain.add(from_addr)
 
-                    for addr in update_addrs_plain:
-                        if addr in plain_addrs_from:
-                            plain_addrs_from[addr].updateHeights(tx_height)
-                    for addr in update_addrs_blind:
-                        if addr in blind_addrs_from:
-                            blind_addrs_from[addr].updateHeights(tx_height)
+                    for from_addr in update_addrs_plain:
+                        if from_addr in plain_addrs_from:
+                            plain_addrs_from[from_addr].updateHeights(tx_height)
+                    for from_addr in update_addrs_blind:
+                        if from_addr in blind_addrs_from:
+                            blind_addrs_from[from_addr].updateHeights(tx_height)
 
                 except Exception as e:
                     print('error format output', e)
                     print('txid source', txid)
-                    print('txid input', tx_input['txid'])
-                    print('vout input', tx_input['vout'])
-                    print('prev_tx', json.dumps(prev_tx, indent=4))
+                    print('txid input', tx_input.txid)
+                    print('vout input', tx_input.n)
 
         print('num_anon_inputs', num_anon_inputs)
         print('num_blind_inputs', len(blind_addrs_from))
@@ -1,13 +1,15 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import time
 import hashlib
 
 from ecc_util import (
-    ep, G,
+    ep, G, H,
     b2h, b2i, i2b, i2h, h2b,
     ToDER, pointToCPK2, pointToCPK, CPKToPoint,
-    hashToCurve, validKey
+    hashToCurve, validKey, multiScalarMul,
+    getInsecureInt
 )
 from contrib.rfc6979 import secp256k1_rfc6979_hmac_sha256_initialize, secp256k1_rfc6979_hmac_sha256_generate
 from contrib.ellipticcurve import INFINITY
@@ -97,7 +99,7 @@ def generateMLSAG(rows, cols, real_column, nonce, preimage, secret_keys, pk_matr
             s = b2i(bs)
             offset = (i + k * cols) * 33
             Pb = pk_matrix_with_last_row[offset: offset + 33]
-            L = G * s + CPKToPoint(Pb) * last_c
+            L = multiScalarMul([(s, G), (last_c, CPKToPoint(Pb))])
 
             h.update(Pb)
             h.update(pointToCPK(L))
@@ -107,7 +109,7 @@ def generateMLSAG(rows, cols, real_column, nonce, preimage, secret_keys, pk_matr
                 continue
 
             # R = H(pk[k][i]) * ss + ki[k] * clast
-            R = hashToCurve(Pb) * s + CPKToPoint(sig.keyimages[k]) * last_c
+            R = multiScalarMul([(s, hashToCurve(Pb)), (last_c, CPKToPoint(sig.keyimages[k]))])
             h.update(pointToCPK(R))
 
         hash_result = h.digest()
@@ -140,7 +142,7 @@ def verifyMLSAG(rows, cols, preimage, pk_matrix_with_last_row, sig):
             P = CPKToPoint(Pb)
             s = b2i(sig.sig_s[i + k * cols])
             c = b2i(c_verify)
-            L = G * s + P * c
+            L = multiScalarMul([(s, G), (c, P)])
 
             h.update(Pb)
             h.update(pointToCPK(L))
@@ -150,7 +152,7 @@ def verifyMLSAG(rows, cols, preimage, pk_matrix_with_last_row, sig):
                 continue
 
             # R = H(pk[k][i]) * ss + ki[k] * clast
-            R = hashToCurve(Pb) * s + CPKToPoint(sig.keyimages[k]) * c
+            R = multiScalarMul([(s, hashToCurve(Pb)), (c, CPKToPoint(sig.keyimages[k]))])
             h.update(pointToCPK(R))
 
         c_verify = h.digest()
@@ -159,7 +161,7 @@ def verifyMLSAG(rows, cols, preimage, pk_matrix_with_last_row, sig):
 
 
 def main():
-    HG = hashToCurve(ToDER(G))
+    HG = H  # Fixed base, hashToCurve(ToDER(G))
     print('G: ', b2h(ToDER(G)))
     print('HG:', b2h(ToDER(HG)))
 
@@ -275,7 +277,9 @@ def main():
     h.update(sig.sig_s_bytes())
     assert(h.hexdigest() == '48238c7b4c9884881f7d7d4556d72df43bb5f7004a07574285a3f535b68c38f7')
 
+    t = time.time()
     assert(verifyMLSAG(rows, cols, preimage, h2b(hex_pk_matrix_with_last_row), sig) is True)
+    print('verifyMLSAG {}x{} took {:.3f}s'.format(rows, cols, time.time() - t))
 
     rows = 3  # Including commitments row
     cols = 3
@@ -365,10 +369,29 @@ def main():
     h.update(sig.sig_s_bytes())
     assert(h.hexdigest() == '7c5929f503bf9e15f5e6382fd7f1780a2dc099d10e6a673aaadedf036e463eb7')
 
+    t = time.time()
     assert(verifyMLSAG(rows, cols, preimage, h2b(hex_pk_matrix_with_last_row), sig) is True)
+    print('verifyMLSAG {}x{} took {:.3f}s'.format(rows, cols, time.time() - t))
 
     print('Done')
 
 
+def benchmarkVerifyMLSAG(rows=3, cols=11, num_runs=5):
+    # Random keys and signature, verification does the same work whether it passes or not
+    pk_matrix_with_last_row = bytearray()
+    for i in range(rows * cols):
+        pk_matrix_with_last_row += pointToCPK(G * getInsecureInt())
+    sig = MLSAG()
+    sig.keyimages = [pointToCPK(G * getInsecureInt()) for k in range(rows - 1)]
+    sig.sig_c = i2b(getInsecureInt())
+    sig.sig_s = [i2b(getInsecureInt()) for i in range(rows * cols)]
+
+    t = time.time()
+    for i in range(num_runs):
+        verifyMLSAG(rows, cols, bytes(32), pk_matrix_with_last_row, sig)
+    print('verifyMLSAG {}x{}: {:.3f}s each'.format(rows, cols, (time.time() - t) / num_runs))
+
+
 if __name__ == '__main__':
     main()
+    benchmarkVerifyMLSAG()
@@ -12,13 +12,125 @@
 ./particl-cli -rpcwallet=wallet.dat filtertransactions "{\"type\":\"blind\",\"count\":0,\"show_blinding_factors\":true,\"show_anon_spends\":true,\"show_change\":true}"  > ~/blinds_wallet1.txt
 $ python process_wallet_anon_txns.py ~/.particl ~/anons_wallet1.txt > ~/anon1.txt
 
+Anon outputs are resolved in batched rpc calls before the report is written,
+resolved pubkeys and anon indices are cached in ANON_OUTPUT_CACHE_FILE.
+
 """
 
 import os
 import sys
 import json
 import time
-from util import callrpc, make_int
+from util import callrpc, callrpc_batch_results, make_int, stream_json_items
+
+anon_output_cache_file_in = os.getenv('ANON_OUTPUT_CACHE_FILE', '~/anon_output_cache.json')
+anon_output_cache_file = os.path.expanduser(anon_output_cache_file_in)
+
+
+class AnonOutputResolver():
+    """Collects the txns, pubkeys and anon indices a dump needs, then resolves them in batches."""
+    def __init__(self, rpc_port, rpc_auth, cache_path, batch_size=500):
+        self.rpc_port = rpc_port
+        self.rpc_auth = rpc_auth
+        self.cache_path = cache_path
+        self.batch_size = batch_size
+
+        self.txns = {}  # txid -> (height, [pubkey, ]) or the Exception raised
+        self.pubkey_to_index = {}
+        self.index_to_pubkey = {}
+        self.pubkey_errors = {}  # pubkey -> Exception from anonoutput, not cached
+        self.index_errors = {}  # anon index -> Exception from anonoutput, not cached
+        if os.path.exists(cache_path):
+            with open(cache_path) as fp:
+                self.pubkey_to_index = json.load(fp)['pubkey_to_index']
+        for pubkey, ao_index in self.pubkey_to_index.items():
+            self.index_to_pubkey[ao_index] = pubkey
+
+        self.need_txids = set()
+        self.need_outputs = set()
+        self.need_indices = set()
+
+    def add_txid(self, txid):
+        self.need_txids.add(txid)
+
+    def add_output(self, txid, n):
+        # Resolve the anon index of output n of txid
+        self.need_txids.add(txid)
+        self.need_outputs.add((txid, n))
+
+    def add_index(self, ao_index):
+        self.need_indices.add(ao_index)
+
+    def call_batches(self, calls):
+        """Returns the result or an Exception with the call's error for each call."""
+        rv = []
+        for i in range(0, len(calls), self.batch_size):
+            batch = calls[i: i + self.batch_size]
+            for result, error in callrpc_batch_results(self.rpc_port, self.rpc_auth, batch):
+                rv.append(result if error is None else ValueError('RPC error ' + str(error)))
+        return rv
+
+    def resolve(self):
+        txids = [txid for txid in self.need_txids if txid not in self.txns]
+        for txid, tx in zip(txids, self.call_batches([('getrawtransaction', [txid, True]) for txid in txids])):
+            if isinstance(tx, Exception):
+                self.txns[txid] = tx
+            else:
+                self.txns[txid] = (tx.get('height'), [txo.get('pubkey') for txo in tx['vout']])
+
+        pubkeys = set()
+        for txid, n in self.need_outputs:
+            tx = self.txns[txid]
+            if not isinstance(tx, Exception) and n < len(tx[1]) and tx[1][n] not in self.pubkey_to_index:
+                pubkeys.add(tx[1][n])
+        pubkeys = list(pubkeys)
+        for pubkey, ao in zip(pubkeys, self.call_batches([('anonoutput', [pubkey]) for pubkey in pubkeys])):
+            if isinstance(ao, Exception):
+                self.pubkey_errors[pubkey] = ao
+            else:
+                self.pubkey_errors.pop(pubkey, None)
+                self.pubkey_to_index[pubkey] = ao['index']
+                self.index_to_pubkey[ao['index']] = pubkey
+
+        indices = [ao_index for ao_index in self.need_indices if ao_index not in self.index_to_pubkey]
+        for ao_index, ao in zip(indices, self.call_batches([('anonoutput', [str(ao_index)]) for ao_index in indices])):
+            if isinstance(ao, Exception):
+                self.index_errors[ao_index] = ao
+            else:
+                self.index_errors.pop(ao_index, None)
+                self.pubkey_to_index[ao['publickey']] = ao_index
+                self.index_to_pubkey[ao_index] = ao['publickey']
+
+        self.need_txids.clear()
+        self.need_outputs.clear()
+        self.need_indices.clear()
+
+    def save(self):
+        with open(self.cache_path, 'w') as fp:
+            json.dump({'pubkey_to_index': self.pubkey_to_index}, fp)
+
+    def get_tx(self, txid):
+        """Returns (height, [pubkey, ]), raises the error from getrawtransaction."""
+        tx = self.txns[txid]
+        if isinstance(tx, Exception):
+            raise tx
+        return tx
+
+    def get_output_pubkey(self, txid, n):
+        return self.get_tx(txid)[1][n]
+
+    def get_output_index(self, txid, n):
+        """Raises the error from getrawtransaction or anonoutput."""
+        pubkey = self.get_output_pubkey(txid, n)
+        if pubkey in self.pubkey_errors:
+            raise self.pubkey_errors[pubkey]
+        return self.pubkey_to_index[pubkey]
+
+    def get_pubkey(self, ao_index):
+        """Raises the error from anonoutput."""
+        if ao_index in self.index_errors:
+            raise self.index_errors[ao_index]
+        return self.index_to_pubkey[ao_index]
 
 
 def main():
@@ -39,25 +151,34 @@ def main():
     r = callrpc(rpc_port, rpc_auth, 'getnetworkinfo')
     print('version', r['version'])
 
-    json_objs = []
-    with open(input_file) as fp:
-        end_char = None
-        json_txt = ''
-        for line in fp:
-            sline = line.rstrip()
-            if end_char is None:
-                if sline == '[':
-                    end_char = ']'
-                elif sline == '{':
-                    end_char = '}'
-
-            if end_char is not None:
-                json_txt += line
-
-                if sline == end_char:
-                    json_objs.append(json.loads(json_txt))
-                    json_txt = ''
-                    end_char = None
+    resolver = AnonOutputResolver(rpc_port, rpc_auth, anon_output_cache_file)
+
+    def collect_traced_frozen_tx(tx):
+        for output in tx['outputs']:
+            if output['type'] == 'anon':
+                resolver.add_index(output['anon_index'])
+                if 'spent_by' in output:
+                    resolver.add_txid(output['spent_by'])
+        if 'inputs' in tx and not isinstance(tx['inputs'], str):
+            for txi in tx['inputs']:
+                collect_traced_frozen_tx(txi)
+
+    # Collect everything the report needs and resolve it before writing
+    for document_index, key, item in stream_json_items(input_file):
+        if key == 'frozen_outputs':
+            if 'anon_index' not in item and item['type'] == 'anon':
+                resolver.add_output(item['txid'], item['n'])
+        elif key == 'transactions':
+            collect_traced_frozen_tx(item)
+        elif key is None:
+            resolver.add_txid(item['txid'])
+            for ai in item.get('anon_inputs', []):
+                resolver.add_output(ai['txid'], ai['n'])
+            for vout_wallet in item['outputs']:
+                if vout_wallet.get('type') == 'anon':
+                    resolver.add_output(item['txid'], vout_wallet['vout'])
+    resolver.resolve()
+    resolver.save()
 
     num_anon_outputs = 0
     txid_set = set()
@@ -71,13 +192,12 @@ def main():
             blindingfactor = output['blind']
             if output['type'] == 'anon':
                 ao_index = output['anon_index']
-                ao = callrpc(rpc_port, rpc_auth, 'anonoutput', [str(ao_index)])
-                pubkey = ao['publickey']
+                pubkey = resolver.get_pubkey(ao_index)
                 print('%d,%s,%d,%s' % (ao_index, pubkey, output_amount, blindingfactor))
 
                 if 'spent_by' in output:
-                    spendtx = callrpc(rpc_port, rpc_auth, 'getrawtransaction', [output['spent_by'], True])
-                    anon_spends[ao_index] = (spendtx['height'], output['spent_by'])
+                    spend_height = resolver.get_tx(output['spent_by'])[0]
+                    anon_spends[ao_index] = (spend_height, output['spent_by'])
 
             elif output['type'] == 'blind':
                 ct_values.append((tx['txid'], n, output_amount, blindingfactor))
@@ -87,71 +207,66 @@ def main():
             for txi in tx['inputs']:
                 inspect_traced_frozen_tx(txi)
 
-    for input_json in json_objs:
-        if isinstance(input_json, dict):
-            if 'frozen_outputs' in input_json:
-                # Output from: debugwallet "{\"trace_frozen_outputs\":true}"
+    last_section = None
+    for document_index, key, item in stream_json_items(input_file):
+        new_section = (document_index, key) != last_section
+        last_section = (document_index, key)
+        if key == 'frozen_outputs':
+            # Output from: debugwallet "{\"trace_frozen_outputs\":true}"
+            if new_section:
                 print('\nSpends:')
-                for tx in input_json['frozen_outputs']:
-                    if 'anon_index' in tx:
-                        print('{},U'.format(tx['anon_index']))
-                    elif tx['type'] == 'anon':
-                        tx_in_chain = callrpc(rpc_port, rpc_auth, 'getrawtransaction', [tx['txid'], True])
-                        ao_pk = tx_in_chain['vout'][tx['n']]['pubkey']
-                        ao = callrpc(rpc_port, rpc_auth, 'anonoutput', [ao_pk, ])
-                        print('{},U'.format(ao['index']))
-            else:
-                # Output from: debugwallet "{\"trace_frozen_outputs\":true}"
-                for tx in input_json['transactions']:
-                    inspect_traced_frozen_tx(tx)
-        else:
+            tx = item
+            if 'anon_index' in tx:
+                print('{},U'.format(tx['anon_index']))
+            elif tx['type'] == 'anon':
+                print('{},U'.format(resolver.get_output_index(tx['txid'], tx['n'])))
+        elif key == 'transactions':
+            # Output from: debugwallet "{\"trace_frozen_outputs\":true}"
+            inspect_traced_frozen_tx(item)
+        elif key is None:
             # Output from filtertransactions
-            print('Anon values:')
-            for r in input_json:
-                txid = r['txid']
-                txid_set.add(txid)
-
-                try:
-                    tx = callrpc(rpc_port, rpc_auth, 'getrawtransaction', [txid, True])
-                except Exception as e:
-                    # No such mempool or blockchain transaction.
-                    print('Error: getrawtransaction:', txid, str(e), file=sys.stderr)
+            if new_section:
+                print('Anon values:')
+            r = item
+            txid = r['txid']
+            txid_set.add(txid)
+
+            try:
+                tx_height = resolver.get_tx(txid)[0]
+            except Exception as e:
+                # No such mempool or blockchain transaction.
+                print('Error: getrawtransaction:', txid, str(e), file=sys.stderr)
+                continue
+
+            if 'anon_inputs' in r:
+                for ai in r['anon_inputs']:
+                    ao_index = resolver.get_output_index(ai['txid'], ai['n'])
+                    anon_spends[ao_index] = (tx_height, txid)
+
+            for vout_wallet in r['outputs']:
+                if 'type' not in vout_wallet:
+                    # standard tx
                     continue
+                if vout_wallet['type'] == 'anon':
+                    num_anon_outputs += 1
+                    output_amount = make_int(vout_wallet['amount'])
+
+                    if output_amount < 0:
+                        continue
+
+                    if vout_wallet['vout'] == 65535:
+                        print('reconstructed')  # Should only happen when output_amount > 0
+                    pubkey = resolver.get_output_pubkey(txid, vout_wallet['vout'])
+                    ao_index = resolver.get_output_index(txid, vout_wallet['vout'])
 
-                if 'anon_inputs' in r:
-                    for ai in r['anon_inputs']:
-                        prevtx = callrpc(rpc_port, rpc_auth, 'getrawtransaction', [ai['txid'], True])
-                        ao_pk = prevtx['vout'][ai['n']]['pubkey']
-                        ao = callrpc(rpc_port, rpc_auth, 'anonoutput', [ao_pk, ])
-                        ao_index = ao['index']
-                        anon_spends[ao_index] = (tx['height'], txid)
-
-                for vout_wallet in r['outputs']:
-                    if 'type' not in vout_wallet:
-                        # standard tx
+                    print('%d,%s,%d,%s' % (ao_index, pubkey, output_amount, vout_wallet.get('blindingfactor', 'NONE')))
+                elif vout_wallet['type'] == 'blind':
+                    if 'blindingfactor' not in vout_wallet:
                         continue
-                    if vout_wallet['type'] == 'anon':
-                        num_anon_outputs += 1
-                        output_amount = make_int(vout_wallet['amount'])
-
-                        if output_amount < 0:
-                            continue
-
-                        if vout_wallet['vout'] == 65535:
-                            print('reconstructed')  # Should only happen when output_amount > 0
-                        pubkey = tx['vout'][vout_wallet['vout']]['pubkey']
-
-                        ao = callrpc(rpc_port, rpc_auth, 'anonoutput', [pubkey, ])
-                        ao_index = ao['index']
-
-                        print('%d,%s,%d,%s' % (ao_index, pubkey, output_amount, vout_wallet.get('blindingfactor', 'NONE')))
-                    elif vout_wallet['type'] == 'blind':
-                        if 'blindingfactor' not in vout_wallet:
-                            continue
-                        output_amount = make_int(vout_wallet['amount'])
-                        blindingfactor = vout_wallet['blindingfactor']
-                        n = vout_wallet['vout']
-                        ct_values.append((txid, n, output_amount, blindingfactor))
+                    output_amount = make_int(vout_wallet['amount'])
+                    blindingfactor = vout_wallet['blindingfactor']
+                    n = vout_wallet['vout']
+                    ct_values.append((txid, n, output_amount, blindingfactor))
 
     print('\nTransaction ids:')
     for txid in txid_set:
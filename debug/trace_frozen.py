@@ -21,23 +21,120 @@ Verifies
 ./particl-cli -rpcwallet=wallet.dat debugwallet "{\"trace_frozen_outputs\":true}"  > ~/trace_wallets.txt
 $ python trace_frozen.py ~/.particl ~/trace_wallets.txt
 
+Txns and anon outputs referenced by the claimed input trees are fetched once
+each, on TRACE_WORKERS threads, before tracing.
+Commitments are verified locally, without the verifycommitment rpc.
+$ TRACE_WORKERS=16 python trace_frozen.py ~/.particl ~/trace_wallets.txt
+
 """
 
 import os
 import sys
 import json
 import time
-from util import callrpc, make_int, format8, b58decode, COIN
+import concurrent.futures
+from util import callrpc, make_int, b58decode, stream_json_items, COIN
 from ecc_util import hashToCurve, pointToCPK, G, b2i, b2h
+from commitment_util import CommitmentVerifier
 
 persistent_data_file_in = os.getenv('PERSISTENT_DATA_FILE', '~/trace_frozen_data.json')
 persistent_data_file = os.path.expanduser(persistent_data_file_in)
+trace_workers = int(os.getenv('TRACE_WORKERS', '8'))
+trace_group_size = 64
 
 
 def fromWIF(x):
     return b58decode(x)[1:-5]
 
 
+class TraceCache():
+    """Memoizes the rpc results shared between claimed input trees."""
+    def __init__(self, rpc_port, rpc_auth, num_workers):
+        self.rpc_port = rpc_port
+        self.rpc_auth = rpc_auth
+        self.num_workers = num_workers
+        self.verifier = CommitmentVerifier()
+
+        self.txns = {}
+        self.commitments = {}  # (txid, n, blind, value) -> bool
+        self.anon_outputs = {}  # pubkey -> anon index
+
+    def getrawtransaction(self, txid):
+        tx = self.txns.get(txid)
+        if tx is None:
+            tx = callrpc(self.rpc_port, self.rpc_auth, 'getrawtransaction', [txid, True])
+            self.txns[txid] = tx
+        return tx
+
+    def verifycommitment(self, txid, n, commitment, blind, value):
+        key = (txid, n, blind, value)
+        rv = self.commitments.get(key)
+        if rv is None:
+            rv = self.verifier.verify(commitment, blind, value)
+            self.commitments[key] = rv
+        return rv
+
+    def verify_commitments(self, checks):
+        """Verify (txid, n, commitment, blind, value) tuples not already cached in one batch."""
+        checks = [c for c in dict.fromkeys(checks) if (c[0], c[1], c[3], c[4]) not in self.commitments]
+        results = self.verifier.verifyBatch([(commitment, blind, value) for txid, n, commitment, blind, value in checks])
+        for (txid, n, commitment, blind, value), rv in zip(checks, results):
+            self.commitments[(txid, n, blind, value)] = rv
+
+    def anonoutput(self, pubkey):
+        rv = self.anon_outputs.get(pubkey)
+        if rv is None:
+            rv = callrpc(self.rpc_port, self.rpc_auth, 'anonoutput', [pubkey])['index']
+            self.anon_outputs[pubkey] = rv
+        return rv
+
+    def run_concurrent(self, jobs):
+        """Run (func, args) pairs on the worker pool, duplicates are run once."""
+        jobs = list(dict.fromkeys(jobs))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.num_workers) as executor:
+            for r in executor.map(lambda job: job[0](*job[1]), jobs):
+                pass
+
+    def prefetch(self, itxs):
+        """Fetch and verify everything referenced by the claimed input trees, one tree level at a time."""
+        expanded = set()
+        level = list(itxs)
+        while len(level) > 0:
+            self.run_concurrent([(self.getrawtransaction, (itx['txid'], )) for itx in level])
+
+            jobs = []
+            checks = []
+            next_level = []
+            for itx in level:
+                txid = itx['txid']
+                tx = self.txns[txid]
+                claimed_outputs = {}
+                for txo_verify in itx['outputs']:
+                    claimed_outputs.setdefault(txo_verify['n'], txo_verify)
+                for txo in tx['vout']:
+                    if txo['type'] not in ['anon', 'blind'] or txo['n'] not in claimed_outputs:
+                        continue
+                    txo_verify = claimed_outputs[txo['n']]
+                    checks.append((txid, txo['n'], txo['valueCommitment'], txo_verify['blind'], txo_verify['value']))
+                    if txo['type'] == 'anon':
+                        jobs.append((self.anonoutput, (txo['pubkey'], )))
+
+                if txid in expanded:
+                    continue
+                expanded.add(txid)
+                if itx['input_type'] != 'plain' and 'inputs' in itx:
+                    if itx['inputs'] != 'repeat':
+                        next_level.extend(itx['inputs'])
+                else:
+                    for txin in tx['vin']:
+                        if 'type' in txin and txin['type'] != 'standard':
+                            continue
+                        jobs.append((self.getrawtransaction, (txin['txid'], )))
+            self.run_concurrent(jobs)
+            self.verify_commitments(checks)
+            level = next_level
+
+
 def main():
     use_anon_spend_keys = False
     particl_data_dir = os.path.expanduser(sys.argv[1])
@@ -56,6 +153,7 @@ def main():
         rpc_auth = fp.read()
 
     rpc_port = 51735 if chain == 'mainnet' else 51935
+    cache = TraceCache(rpc_port, rpc_auth, trace_workers)
 
     r = callrpc(rpc_port, rpc_auth, 'getnetworkinfo')
     print('Core version', r['version'])
@@ -72,9 +170,6 @@ def main():
     print('Spent anon indices', len(spent_anon_inputs))
     print('Blacklisted anon outputs', len(blacklisted_aos))
 
-    with open(input_file) as fp:
-        input_json = json.load(fp)
-
     used_keyimages = set()
 
     inputs_map = {}
@@ -82,7 +177,7 @@ def main():
     def trace_tx_inputs(itx, spending_txid, spending_tx, issues):
         #print(json.dumps(itx, indent=4))
         txid = itx['txid']
-        tx = callrpc(rpc_port, rpc_auth, 'getrawtransaction', [txid, True])
+        tx = cache.getrawtransaction(txid)
 
         if 'ct_fee' in tx['vout'][0]:
             ct_fee = tx['vout'][0]['ct_fee']
@@ -113,12 +208,10 @@ def main():
                         if txo_verify['value'] > 200 * COIN:
                             claimed_outputs.append((txo['n'], txo_type, txo_verify['anon_index'] if txo_type == 'anon' else None, txo_verify['value']))
 
-                    try:
-                        rv = callrpc(rpc_port, rpc_auth, 'verifycommitment', [txo['valueCommitment'], txo_verify['blind'], format8(txo_verify['value'])])
-                        assert(rv['result'] is True)
+                    if cache.verifycommitment(txid, txo['n'], txo['valueCommitment'], txo_verify['blind'], txo_verify['value']):
                         total_out += txo_verify['value']
                         known_output_values[txo['n']] = (txo_type, txo_verify['value'])
-                    except Exception as e:
+                    else:
                         warning = 'Warning: verifycommitment failed for output {} for tx {}.'.format(txo['n'], txid)
                         print(warning)
                         issues.append(warning)
@@ -132,8 +225,7 @@ def main():
                             issues.append(warning)
 
                         pubkey = txo['pubkey']
-                        ao_check = callrpc(rpc_port, rpc_auth, 'anonoutput', [pubkey])
-                        assert(ao_check['index'] == anon_index)
+                        assert(cache.anonoutput(pubkey) == anon_index)
 
                     if spending_txid is not None and 'spent_by' in txo_verify and spending_txid == txo_verify['spent_by']:
                         spent_out += txo_verify['value']
@@ -218,7 +310,7 @@ def main():
                     print(warning)
                     issues.append(warning)
                 else:
-                    prev_tx = callrpc(rpc_port, rpc_auth, 'getrawtransaction', [txin['txid'], True])
+                    prev_tx = cache.getrawtransaction(txin['txid'])
                     prevout = prev_tx['vout'][txin['vout']]
                     if prevout['type'] != 'standard':
                         warning = 'Warning: Missing blinded inputs for tx {}.'.format(txid)
@@ -265,15 +357,32 @@ def main():
 
     txns_likely_valid = []
     txns_check_further = []
-    for itx in input_json['transactions']:
-        print('')
-        issues = []
-        outputs = trace_tx_inputs(itx, None, None, issues)
-        if len(issues) == 0:
-            txns_likely_valid.append((itx['txid'], outputs))
-        else:
-            txns_check_further.append((itx['txid'], outputs))
+
+    def trace_claimed_txns(itxs):
+        cache.prefetch(itxs)
+        for itx in itxs:
+            print('')
+            issues = []
+            outputs = trace_tx_inputs(itx, None, None, issues)
+            if len(issues) == 0:
+                txns_likely_valid.append((itx['txid'], outputs))
+            else:
+                txns_check_further.append((itx['txid'], outputs))
+
+    # Claimed txns are streamed from the input file and traced in groups
+    print('Prefetching with {} workers'.format(trace_workers))
+    itxs = []
+    for document_index, key, itx in stream_json_items(input_file, stream_keys=('transactions', )):
+        if key != 'transactions':
+            continue
+        itxs.append(itx)
+        if len(itxs) >= trace_group_size:
+            trace_claimed_txns(itxs)
+            itxs = []
+    trace_claimed_txns(itxs)
     print('')
+    print('Txns fetched', len(cache.txns))
+    print('Commitments verified', len(cache.commitments))
 
     print('Likely valid txids:')
     for pair in txns_likely_valid:
@@ -28,9 +28,10 @@ import os
 import sys
 import json
 import time
-import sqlite3
-from util import callrpc, make_int, format8, b58decode, COIN
+from util import callrpc, make_int, b58decode, COIN
 from ecc_util import hashToCurve, pointToCPK, G, b2i, b2h
+from commitment_util import CommitmentVerifier
+from chain_stats_db import ChainStatsDB
 
 persistent_data_file_in = os.getenv('PERSISTENT_DATA_FILE', '~/trace_frozen_data.json')
 persistent_data_file = os.path.expanduser(persistent_data_file_in)
@@ -45,6 +46,28 @@ def fromWIF(x):
     return b58decode(x)[1:-5]
 
 
+class SpendingTxIndex():
+    """Ring members and keyimages of a spending tx, parsed once."""
+    __slots__ = ('ring_members', 'keyimages')
+
+    def __init__(self, tx):
+        self.ring_members = {}  # anon_index -> (vin, row, column)
+        self.keyimages = {}  # keyimage hex -> (vin, row)
+        for vin_n, txin in enumerate(tx['vin']):
+            for i in range(1000):
+                row = 'ring_row_{}'.format(i)
+                if row not in txin:
+                    break
+                for column, ai in enumerate(txin[row].split(',')):
+                    self.ring_members.setdefault(int(ai.strip()), (vin_n, i, column))
+            for sd in txin.get('scriptdata', []):
+                # Keyimages are concatenated, 33 bytes per ring row
+                if len(sd) % 66 != 0:
+                    continue
+                for i in range(len(sd) // 66):
+                    self.keyimages.setdefault(sd[i * 66: (i + 1) * 66], (vin_n, i))
+
+
 def main():
     use_anon_spend_keys = False
     particl_data_dir = os.path.expanduser(sys.argv[1])
@@ -64,6 +87,7 @@ def main():
         rpc_auth = fp.read()
 
     rpc_port = 51735 if chain == 'mainnet' else 51935
+    verifier = CommitmentVerifier()
 
     r = callrpc(rpc_port, rpc_auth, 'getnetworkinfo')
     print('Time', time.strftime('%Y-%m-%d %H:%M:%S %Z', time.gmtime()))
@@ -86,14 +110,25 @@ def main():
         input_json = json.load(fp)
 
     try:
-        dbc = sqlite3.connect(chain_info_db_file)
+        dbc = ChainStatsDB(chain_info_db_file)
     except Exception as e:
         print('chain_info_db_file not found', e)
         dbc = None
 
+    # Resolve the outputs of all claimed txns in one query
+    claimed_db_outputs = {}
+    if dbc is not None:
+        claimed_db_outputs = dbc.get_outputs([(itx['txid'], txo_verify['n']) for itx in input_json['transactions'] for txo_verify in itx['outputs']])
+
     used_keyimages = set()
     inputs_map = {}
     wallet_names = []
+    spending_tx_indices = {}
+
+    def get_spending_tx_index(spending_txid, spending_tx):
+        if spending_txid not in spending_tx_indices:
+            spending_tx_indices[spending_txid] = SpendingTxIndex(spending_tx)
+        return spending_tx_indices[spending_txid]
 
     def replace_wallet_name(wallet_name):
         replaced = []
@@ -149,15 +184,11 @@ def main():
                             claimed_outputs.append((txo['n'], txo_type, txo_verify['anon_index'] if txo_type == 'anon' else None, txo_verify['value']))
 
                             if dbc is not None and txo_type == 'blind':
-                                cur = dbc.cursor()
-                                cur.execute('SELECT spent_txid FROM outputs WHERE txid = "{}" AND n = {}'.format(txid, txo['n']))
-                                assert(cur.fetchone()[0] is None)
-                    try:
-                        rv = callrpc(rpc_port, rpc_auth, 'verifycommitment', [txo['valueCommitment'], txo_verify['blind'], format8(txo_verify['value'])])
-                        assert(rv['result'] is True)
+                                assert(claimed_db_outputs[(txid, txo['n'])][2] is None)
+                    if verifier.verify(txo['valueCommitment'], txo_verify['blind'], txo_verify['value']):
                         total_out += txo_verify['value']
                         known_output_values[txo['n']] = (txo_type, txo_verify['value'])
-                    except Exception as e:
+                    else:
                         warning = 'Warning: verifycommitment failed for output {} for tx {}.'.format(txo['n'], txid)
                         tx_issues.append(warning)
                     found_vout = True
@@ -177,18 +208,7 @@ def main():
                         # Verify anon_index is possible
                         if txo_type == 'anon':
                             anon_index = txo_verify['anon_index']
-                            found_input = False
-                            for txin in spending_tx['vin']:
-                                for i in range(1000):
-                                    row = 'ring_row_{}'.format(i)
-                                    if row not in txin:
-                                        break
-                                    ais = txin[row].split(',')
-                                    for ai in ais:
-                                        if anon_index == int(ai.strip()):
-                                            found_input = True
-                                            break
-                            assert(found_input)
+                            assert(anon_index in get_spending_tx_index(spending_txid, spending_tx).ring_members)
 
                             if str(anon_index) in spent_anon_inputs:
                                 assert(spent_anon_inputs[str(anon_index)] == spending_txid)
@@ -204,13 +224,7 @@ def main():
                             expect_keyimage_b = pointToCPK(expect_keyimage)
                             expect_keyimage_str = b2h(expect_keyimage_b)
                             # Match keyimage to tx vin
-                            found_ki = False
-                            for txin in spending_tx['vin']:
-                                for sd in txin['scriptdata']:
-                                    if expect_keyimage_str in sd:
-                                        found_ki = True
-                                        break
-                            assert(found_ki)
+                            assert(expect_keyimage_str in get_spending_tx_index(spending_txid, spending_tx).keyimages)
 
                             assert(expect_keyimage_b not in used_keyimages)
                             used_keyimages.add(expect_keyimage_b)
@@ -288,13 +302,11 @@ def main():
                     num_inputs += 1
 
             if dbc is not None and len(known_input_values) < num_inputs:
-                cur = dbc.cursor()
                 total_possible_input = 0
                 values_matrix = []
                 for txin in tx['vin']:
                     if 'type' in txin and txin['type'] == 'blind':
-                        cur.execute('SELECT value, is_estimate FROM outputs WHERE txid=? AND n=?', (txin['txid'], txin['vout']))
-                        total_possible_input += cur.fetchone()[0]
+                        total_possible_input += dbc.get_output(txin['txid'], txin['vout'])[0]
                     elif 'type' in txin and txin['type'] == 'anon':
                         print('\t' + 'MLSAG rows, cols:', txin['num_inputs'], txin['ring_size'])
                         str_hdr = ''
@@ -306,10 +318,9 @@ def main():
                         for i in range(txin['num_inputs']):
                             ring_row = txin['ring_row_{}'.format(i)]
                             ais = [int(i) for i in ring_row.split(', ')]
-                            cur.execute('SELECT value, is_estimate, anon_index, spent_txid FROM outputs WHERE anon_index IN ({})'.format(','.join(['?'] * len(ais))), (ais))
                             aos = {}
-                            for r in cur.fetchall():
-                                ao_value, ao_is_estimate, aoi, ao_spent_txid = r
+                            for aoi, r in dbc.get_anon_outputs(ais).items():
+                                ao_value, ao_is_estimate, ao_spent_txid = r
                                 ao_note = ''
                                 if ao_spent_txid is not None and ao_spent_txid != txid:
                                     ao_note = 'S'  # Spent elsewhere
@@ -324,7 +335,6 @@ def main():
                         total_possible_input += max(sum_column_vals)
                     else:
                         num_inputs += 1
-                cur.close()
 
                 print('\ttotal_possible_input', total_possible_input)
                 itx['total_possible_input'] = total_possible_input
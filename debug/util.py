@@ -15,7 +15,7 @@ from xmlrpc.client import (
 )
 
 COIN = 100000000
-DCOIN = decimal.Decimal(COIN)
+MAX_SHIFT = 32  # Largest power of ten accepted from an exponent
 __b58chars = '123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz'
 
 
@@ -111,16 +111,29 @@ class Jsonrpc():
             self.__transport.close()
 
     def json_request(self, method, params):
-        try:
-            connection = self.__transport.make_connection(self.__host)
-            headers = self.__transport._extra_headers[:]
-
+        self.request_id += 1
+        request_body = {
+            'method': method,
+            'params': params,
+            'id': self.request_id
+        }
+        return self.post(request_body)
+
+    def json_batch_request(self, calls):
+        request_body = []
+        for method, params in calls:
             self.request_id += 1
-            request_body = {
+            request_body.append({
                 'method': method,
                 'params': params,
                 'id': self.request_id
-            }
+            })
+        return self.post(request_body)
+
+    def post(self, request_body):
+        try:
+            connection = self.__transport.make_connection(self.__host)
+            headers = self.__transport._extra_headers[:]
 
             connection.putrequest('POST', self.__handler)
             headers.append(('Content-Type', 'application/json'))
@@ -158,6 +171,43 @@ def callrpc(rpc_port, auth, method, params=[], wallet=None):
     return r['result']
 
 
+def callrpc_batch_results(rpc_port, auth, calls, wallet=None):
+    """Send a list of (method, params) pairs in one request.
+
+    Returns a (result, error) pair for each call in order, so one failed call doesn't hide the others.
+    """
+    if len(calls) < 1:
+        return []
+    try:
+        url = 'http://{}@127.0.0.1:{}/'.format(auth, rpc_port)
+        if wallet is not None:
+            url += 'wallet/' + urllib.parse.quote(wallet)
+        x = Jsonrpc(url)
+        v = x.json_batch_request(calls)
+        x.close()
+        r = json.loads(v.decode('utf-8'))
+    except Exception as e:
+        traceback.print_exc()
+        raise ValueError('RPC Server Error')
+
+    if not isinstance(r, list):
+        if 'error' in r and r['error'] is not None:
+            raise ValueError('RPC error ' + str(r['error']))
+        raise ValueError('RPC error, unexpected batch response')
+    r.sort(key=lambda x: x['id'])
+    return [(rr.get('result', None), rr.get('error', None)) for rr in r]
+
+
+def callrpc_batch(rpc_port, auth, calls, wallet=None):
+    """Send a list of (method, params) pairs in one request, results are returned in order."""
+    rv = []
+    for result, error in callrpc_batch_results(rpc_port, auth, calls, wallet):
+        if error is not None:
+            raise ValueError('RPC error ' + str(error))
+        rv.append(result)
+    return rv
+
+
 def open_rpc(rpc_port, auth, wallet=None):
     try:
         url = 'http://%s@127.0.0.1:%d/' % (auth, rpc_port)
@@ -179,13 +229,166 @@ def format8(i):
     return rv
 
 
-def dquantize(n, places=8):
-    return n.quantize(decimal.Decimal(10) ** -places)
+def parse_amount(s):
+    """Parse a decimal string into satoshis, raises ValueError if it has more than 8 decimal places.
+
+    Same as parse_amount in amount_util.py at the top level.
+    """
+    s = s.strip()
+    sign = 1
+    if s[:1] in ('-', '+'):
+        if s[0] == '-':
+            sign = -1
+        s = s[1:]
+    mantissa, has_exponent, exponent = s.lower().partition('e')
+    whole, _, frac = mantissa.partition('.')
+    digits = whole + frac
+    if not digits.isdigit() or not digits.isascii():
+        raise ValueError('Invalid amount: ' + s)
+    try:
+        shift = 8 - len(frac) + (int(exponent) if has_exponent else 0)
+    except ValueError:
+        raise ValueError('Invalid amount: ' + s)
+    if shift > MAX_SHIFT:
+        raise ValueError('Invalid amount: ' + s)
+    if shift < 0:
+        if digits[shift:].strip('0') != '':
+            raise ValueError('More than 8 decimal places: ' + s)
+        return sign * int(digits[:shift] or '0')
+    return sign * int(digits) * 10 ** shift
 
 
 def make_int(v):
-    return int(dquantize(decimal.Decimal(v) * DCOIN).quantize(decimal.Decimal(1)))
+    """Convert an amount from rpc json or a string to satoshis."""
+    if isinstance(v, int):
+        return v * COIN
+    if isinstance(v, float):
+        # The shortest repr of a float parsed from json is the daemon's fixed point string
+        try:
+            return parse_amount(repr(v))
+        except ValueError:
+            return round(v * COIN)
+    return parse_amount(v)
 
 
 def strtobool(s):
     return s.lower() in ['1', 'true']
+
+
+class JsonStreamReader():
+    """Reads json documents from a file one array element at a time.
+
+    Yields (document_index, key, value) tuples:
+     - key is None for elements of a top level array.
+     - key is the member name for members of a top level object,
+       elements of members named in stream_keys are yielded one at a time.
+    Lines outside of a json document are skipped.
+    """
+    def __init__(self, fp, stream_keys=('transactions', 'frozen_outputs'), chunk_size=1 << 16):
+        self.fp = fp
+        self.stream_keys = stream_keys
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+
+    def read_more(self, min_size):
+        if self.eof:
+            return False
+        if self.pos > 0:
+            self.buf = self.buf[self.pos:]
+            self.pos = 0
+        data = self.fp.read(max(self.chunk_size, min_size))
+        if len(data) == 0:
+            self.eof = True
+            return False
+        self.buf += data
+        return True
+
+    def peek(self):
+        """Returns the next non whitespace character, '' at the end of the file."""
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in ' \t\r\n':
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self.read_more(0):
+                return ''
+
+    def expect(self, chars):
+        c = self.peek()
+        if c == '' or c not in chars:
+            raise ValueError('Expected one of "{}", found "{}"'.format(chars, c))
+        self.pos += 1
+        return c
+
+    def decode_value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+                # A value ending at the end of the buffer may be truncated, a number for example
+                if end < len(self.buf) or self.eof:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            # Grow geometrically so large values aren't reparsed too often
+            self.read_more(len(self.buf) - self.pos)
+
+    def array_items(self):
+        if self.peek() == ']':
+            self.pos += 1
+            return
+        while True:
+            yield self.decode_value()
+            if self.expect(',]') == ']':
+                return
+
+    def skip_line(self):
+        while True:
+            i = self.buf.find('\n', self.pos)
+            if i >= 0:
+                self.pos = i + 1
+                return
+            self.pos = len(self.buf)
+            if not self.read_more(0):
+                return
+
+    def __iter__(self):
+        document_index = 0
+        while True:
+            c = self.peek()
+            if c == '':
+                return
+            if c == '[':
+                self.pos += 1
+                for value in self.array_items():
+                    yield document_index, None, value
+            elif c == '{':
+                self.pos += 1
+                if self.peek() == '}':
+                    self.pos += 1
+                else:
+                    while True:
+                        key = self.decode_value()
+                        self.expect(':')
+                        if key in self.stream_keys and self.peek() == '[':
+                            self.pos += 1
+                            for value in self.array_items():
+                                yield document_index, key, value
+                        else:
+                            yield document_index, key, self.decode_value()
+                        if self.expect(',}') == '}':
+                            break
+            else:
+                self.skip_line()
+                continue
+            document_index += 1
+
+
+def stream_json_items(file_path, stream_keys=('transactions', 'frozen_outputs')):
+    with open(file_path) as fp:
+        yield from JsonStreamReader(fp, stream_keys)
@@ -14,6 +14,12 @@ $ export BIN_PATH=~/tmp/particl-0.21.2.7/bin
 $ ${BIN_PATH}/particl-qt -server -txindex=1 -testnet
 $ python count_txns.py --days=14 --network=testnet
 
+Fetch blocks in parallel:
+$ python count_txns.py --days=30 --workers=8
+
+The daemon is called over JSON-RPC with the auth cookie from --datadir,
+particl-cli is used if --usecli is set or no cookie is found.
+
 """
 
 __version__ = '0.1'
@@ -21,16 +27,108 @@ __version__ = '0.1'
 import os
 import json
 import time
-import shlex
+import urllib
+import decimal
 import argparse
 import threading
 import subprocess
+import concurrent.futures
+from xmlrpc.client import (
+    Transport,
+    Fault,
+)
 
 
 bin_path = os.path.join(os.path.expanduser(os.getenv('BIN_PATH', '')), 'particl-cli')
+DEFAULT_RPC_PORTS = {'mainnet': 51735, 'testnet': 51935, 'regtest': 51936}
+
+
+def jsonDecimal(obj):
+    if isinstance(obj, decimal.Decimal):
+        return str(obj)
+    raise TypeError
+
+
+class Jsonrpc():
+    def __init__(self, uri, transport=None, encoding=None, verbose=False,
+                 allow_none=False, use_datetime=False, use_builtin_types=False,
+                 *, context=None):
+        self.request_id = 0
+        parsed = urllib.parse.urlparse(uri)
+        if parsed.scheme not in ('http', 'https'):
+            raise OSError('unsupported XML-RPC protocol')
+        self.__host = parsed.netloc
+        self.__handler = parsed.path
+        if not self.__handler:
+            self.__handler = '/RPC2'
+
+        if transport is None:
+            handler = Transport
+            extra_kwargs = {}
+            transport = handler(use_datetime=use_datetime,
+                                use_builtin_types=use_builtin_types,
+                                **extra_kwargs)
+        self.__transport = transport
+
+        self.__encoding = encoding or 'utf-8'
+        self.__verbose = verbose
+        self.__allow_none = allow_none
+
+    def close(self):
+        if self.__transport is not None:
+            self.__transport.close()
+
+    def json_request(self, method, params):
+        self.request_id += 1
+        request_body = {
+            'method': method,
+            'params': params,
+            'id': self.request_id
+        }
+        return self.post(request_body)
+
+    def json_batch_request(self, calls):
+        request_body = []
+        for method, params in calls:
+            self.request_id += 1
+            request_body.append({
+                'method': method,
+                'params': params,
+                'id': self.request_id
+            })
+        return self.post(request_body)
+
+    def post(self, request_body):
+        try:
+            connection = self.__transport.make_connection(self.__host)
+            headers = self.__transport._extra_headers[:]
+
+            connection.putrequest('POST', self.__handler)
+            headers.append(('Content-Type', 'application/json'))
+            headers.append(('User-Agent', 'jsonrpc'))
+            self.__transport.send_headers(connection, headers)
+            self.__transport.send_content(connection, json.dumps(request_body, default=jsonDecimal).encode('utf-8'))
+
+            resp = connection.getresponse()
+            return resp.read()
+
+        except Fault:
+            raise
+        except Exception:
+            # All unexpected errors leave connection in
+            # a strange state, so we clear it.
+            self.__transport.close()
+            raise
+
+
+def open_rpc(rpc_port, auth, wallet=None):
+    url = 'http://{}@127.0.0.1:{}/'.format(auth, rpc_port)
+    if wallet:
+        url += 'wallet/' + urllib.parse.quote(wallet)
+    return Jsonrpc(url)
 
 
-def callrpc(cmd, datadir=None, network=None, wallet=None):
+def callcli(method, params=[], datadir=None, network=None, wallet=None):
     args = [bin_path, ]
 
     if datadir:
@@ -39,7 +137,7 @@ def callrpc(cmd, datadir=None, network=None, wallet=None):
         args += ['--' + network, ]
     if wallet:
         args += ['--rpcwallet=' + wallet, ]
-    args += shlex.split(cmd)
+    args += [method, ] + [p if isinstance(p, str) else json.dumps(p) for p in params]
 
     p = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
 
@@ -48,148 +146,394 @@ def callrpc(cmd, datadir=None, network=None, wallet=None):
     if len(out[1]) > 0:
         raise ValueError(out[1])
 
-    return out[0]
-
+    try:
+        return json.loads(out[0])
+    except json.JSONDecodeError:
+        return out[0].decode('utf-8').strip()
 
-def make_rpc_func(datadir, network, wallet=None):
-    datadir = datadir
-    network = network
-    wallet = wallet
 
-    def rpc_func(cmd, wallet_override=None):
-        nonlocal network, datadir, wallet
-        return callrpc(cmd, datadir, network, wallet if wallet_override is None else wallet_override)
+def get_rpc_port(datadir, network):
+    configpath = os.path.join(datadir, 'particl.conf')
+    if os.path.exists(configpath):
+        with open(configpath) as fp:
+            for line in fp:
+                if line.startswith('#'):
+                    continue
+                pair = line.strip().split('=')
+                if len(pair) == 2 and pair[0] == 'rpcport':
+                    return int(pair[1])
+    return DEFAULT_RPC_PORTS['mainnet' if network == '' else network]
+
+
+def make_rpc_func(datadir, network, wallet=None, rpc_port=0, use_cli=False):
+    """Returns a function calling the daemon over JSON-RPC with cookie auth.
+
+    Each thread keeps its own persistent connection.
+    Falls back to running particl-cli if use_cli is set or no auth cookie is found.
+    rpc_func.batch sends a list of (method, params) pairs in one request.
+    """
+    rpc_auth = None
+    if not use_cli:
+        authcookiepath = os.path.join(datadir, '' if network in ('', 'mainnet') else network, '.cookie')
+        if os.path.exists(authcookiepath):
+            with open(authcookiepath) as fp:
+                rpc_auth = fp.read()
+        else:
+            print('Auth cookie not found, falling back to particl-cli:', authcookiepath)
+    if rpc_port == 0:
+        rpc_port = get_rpc_port(datadir, network)
+    thread_data = threading.local()
+
+    def send(rpc_wallet, request_func):
+        if not hasattr(thread_data, 'conns'):
+            thread_data.conns = {}
+        for i in range(2):
+            if rpc_wallet not in thread_data.conns:
+                thread_data.conns[rpc_wallet] = open_rpc(rpc_port, rpc_auth, rpc_wallet)
+            try:
+                v = request_func(thread_data.conns[rpc_wallet])
+                break
+            except Exception as e:
+                # Reconnect once, the daemon may have closed an idle connection
+                thread_data.conns.pop(rpc_wallet).close()
+                if i > 0:
+                    raise ValueError('RPC Server Error ' + str(e))
+        return json.loads(v.decode('utf-8'))
+
+    def get_result(r):
+        if 'error' in r and r['error'] is not None:
+            raise ValueError('RPC error ' + str(r['error']))
+        return r['result']
+
+    def rpc_func(method, params=[], wallet_override=None):
+        rpc_wallet = wallet if wallet_override is None else wallet_override
+        if rpc_auth is None:
+            return callcli(method, params, datadir, network, rpc_wallet)
+        return get_result(send(rpc_wallet, lambda conn: conn.json_request(method, params)))
+
+    def rpc_batch(calls, wallet_override=None):
+        rpc_wallet = wallet if wallet_override is None else wallet_override
+        if rpc_auth is None:
+            return [callcli(method, params, datadir, network, rpc_wallet) for method, params in calls]
+        if len(calls) < 1:
+            return []
+        rv = send(rpc_wallet, lambda conn: conn.json_batch_request(calls))
+        if not isinstance(rv, list):
+            get_result(rv)
+            raise ValueError('RPC error, unexpected batch response')
+        rv.sort(key=lambda r: r['id'])
+        return [get_result(r) for r in rv]
+
+    rpc_func.batch = rpc_batch
     return rpc_func
 
 
-def main():
-    parser = argparse.ArgumentParser(description=__doc__)
-    parser.add_argument('-v', '--version', action='version',
-                        version='%(prog)s {version}'.format(version=__version__))
-    parser.add_argument('--network', dest='network', default='')
-    parser.add_argument('--datadir', dest='datadir', help='Particl datadir (default=~/.particl)', default='~/.particl', required=False)
-    parser.add_argument('--days', dest='days', help='Number of days to count back', type=int, default=7, required=False)
-    parser.add_argument('--starthash', dest='starthash', help='Block hash to start from', default='', required=False)
-    args = parser.parse_args()
+def block_date(block_data):
+    return time.strftime('%Y-%m-%d', time.gmtime(int(block_data['time'])))
+
+
+class OutputTypeIndex():
+    """Maps txid to the output types of txns in the scanned blocks.
+
+    Outputs created before the scan window are fetched with batched
+    getrawtransaction calls.
+    """
+    def __init__(self, callrpc, batch_size=200):
+        self.callrpc = callrpc
+        self.batch_size = batch_size
+        self.output_types = {}
+        self.num_fetched = 0
+
+    def add_block(self, block_data):
+        for tx in block_data['tx']:
+            self.output_types[tx['txid']] = tuple(txo['type'] for txo in tx['vout'])
+
+    def fetch_missing(self, txids):
+        missing = [txid for txid in set(txids) if txid not in self.output_types]
+        for i in range(0, len(missing), self.batch_size):
+            batch_txids = missing[i: i + self.batch_size]
+            txns = self.callrpc.batch([('getrawtransaction', [txid, True]) for txid in batch_txids])
+            for txid, tx in zip(batch_txids, txns):
+                self.output_types[txid] = tuple(txo['type'] for txo in tx['vout'])
+        self.num_fetched += len(missing)
+
+    def count_pending(self, pending):
+        """Returns [all, coinstake, standard, anon, blind] counts for txns left pending by count_block_txns."""
+        self.fetch_missing([prevout[0] for has_anon, prevouts in pending for prevout in prevouts])
+        counts = [0, 0, 0, 0, 0]
+        for has_anon, prevouts in pending:
+            has_blind = False
+            for txid, n in prevouts:
+                if self.output_types[txid][n] == 'blind':
+                    has_blind = True
+                    break
+            if has_blind:
+                counts[4] += 1
+            if has_anon:
+                counts[3] += 1
+            if not has_blind and not has_anon:
+                counts[2] += 1
+        return counts
+
+
+def count_block_txns(callrpc, block_data, type_index=None):
+    """Returns [all, coinstake, standard, anon, blind] txn counts for a block.
+
+    If type_index is set, no input types are looked up while counting.
+    Txns that have no blinded outputs are only counted in the 'all' column
+    and returned in pending as (has_anon, prevouts), to be counted with
+    OutputTypeIndex.count_pending once all blocks have been scanned.
+    """
+    counts = [0, 0, 0, 0, 0]
+    pending = []
+    if type_index is not None:
+        type_index.add_block(block_data)
+    for tx_i, tx in enumerate(block_data['tx']):
+        counts[0] += 1
+
+        num_anon_in = 0
+        num_blind_in = 0
+        num_standard_in = 0
+
+        num_anon_out = 0
+        num_blind_out = 0
+        num_standard_out = 0
+
+        if tx['version'] == 672 and tx_i == 0:
+            counts[1] += 1
+            continue
+
+        if type_index is not None:
+            has_anon = False
+            has_blind = False
+            for tx_out in tx['vout']:
+                if tx_out['type'] == 'anon':
+                    has_anon = True
+                elif tx_out['type'] == 'blind':
+                    has_blind = True
+            prevouts = []
+            for tx_input in tx['vin']:
+                if 'coinbase' in tx_input:
+                    break
+                if 'type' in tx_input and tx_input['type'] == 'anon':
+                    has_anon = True
+                    continue
+                prevouts.append((tx_input['txid'], tx_input['vout']))
+
+            if has_blind or len(prevouts) < 1:
+                # Input types can't change the classification
+                if has_blind:
+                    counts[4] += 1
+                if has_anon:
+                    counts[3] += 1
+                if not has_blind and not has_anon:
+                    counts[2] += 1
+            else:
+                pending.append((has_anon, prevouts))
+            continue
+
+        for txi_n, tx_input in enumerate(tx['vin']):
+            if 'coinbase' in tx_input:
+                break
+            if 'type' in tx_input and tx_input['type'] == 'anon':
+                num_anon_in += 1
+                continue
 
-    args.datadir = os.path.expanduser(args.datadir)
+            prev_tx = callrpc('getrawtransaction', [tx_input['txid'], True])
+            prevout = prev_tx['vout'][tx_input['vout']]
+            prevout_type = prevout['type']
 
-    print('network', 'mainnet' if args.network == '' else args.network)
+            if prevout_type == 'blind':
+                num_blind_in += 1
+            else:
+                num_standard_in += 1
 
-    callrpc = make_rpc_func(args.datadir, args.network)
+        for tx_out in tx['vout']:
+            tx_out_type = tx_out['type']
+            if tx_out_type == 'anon':
+                num_anon_out += 1
+            elif tx_out_type == 'blind':
+                num_blind_out += 1
+            elif tx_out_type == 'standard':
+                num_standard_out += 1
 
-    delay_event = threading.Event()
+        if num_blind_out + num_blind_in > 0:
+            counts[4] += 1
 
-    if args.starthash == '':
-        block_hash = callrpc('getbestblockhash').strip().decode('utf8')
-    else:
-        block_hash = args.starthash
+        if num_anon_out + num_anon_in > 0:
+            counts[3] += 1
 
-    print('Results from block', block_hash)
+        if num_blind_out + num_blind_in + num_anon_out + num_anon_in == 0:
+            counts[2] += 1
+    return counts, pending
 
-    total_txns = 0
-    day_txns = 0
 
-    total_cs_txns = 0
-    day_cs_txns = 0
+def add_counts(totals, counts):
+    for i, v in enumerate(counts):
+        totals[i] += v
 
-    total_s_txns = 0
-    day_s_txns = 0
 
-    total_a_txns = 0
-    day_a_txns = 0
+def count_pending_days(days, pending_by_date, type_index):
+    for date, pending in pending_by_date.items():
+        if date in days:
+            add_counts(days[date], type_index.count_pending(pending))
+    print('\nInput txns fetched', type_index.num_fetched)
 
-    total_b_txns = 0
-    day_b_txns = 0
 
+def count_days(callrpc, block_hash, num_days_to_count, type_index=None):
+    """Walk back from block_hash one block at a time."""
     days = {}
-
+    pending_by_date = {}
+    total_txns = 0
     num_days = 0
     last_date = ''
+    day_counts = [0, 0, 0, 0, 0]
 
     while True:
-        block_data = json.loads(callrpc(f'getblock {block_hash} 2'))
+        block_data = callrpc('getblock', [block_hash, 2])
 
-        date = time.strftime('%Y-%m-%d', time.gmtime(int(block_data['time'])))
+        date = block_date(block_data)
         if last_date != '' and date != last_date:
             num_days += 1
-            days[last_date] = (day_txns, day_cs_txns, day_s_txns, day_a_txns, day_b_txns)
-            day_txns = 0
-            day_cs_txns = 0
-            day_s_txns = 0
-            day_a_txns = 0
-            day_b_txns = 0
+            days[last_date] = day_counts
+            day_counts = [0, 0, 0, 0, 0]
         last_date = date
 
-        if num_days >= args.days:
+        if num_days >= num_days_to_count:
             break
 
-        for tx_i, tx in enumerate(block_data['tx']):
-            day_txns += 1
-            total_txns += 1
+        block_counts, pending = count_block_txns(callrpc, block_data, type_index)
+        add_counts(day_counts, block_counts)
+        if len(pending) > 0:
+            pending_by_date.setdefault(date, []).extend(pending)
+        total_txns += block_counts[0]
+        print('txns', total_txns, ', day', num_days, end='\r')
+
+        block_hash = block_data['previousblockhash']
 
-            if total_txns % 100:
-                print('txns', total_txns, ', day', num_days, end='\r')
+    if type_index is not None:
+        count_pending_days(days, pending_by_date, type_index)
+    return days
+
+
+def get_block_time(callrpc, height):
+    block_hash = callrpc('getblockhash', [height])
+    return callrpc('getblockheader', [block_hash])['time']
+
+
+def find_first_height(callrpc, from_time, tip_height):
+    """Binary search for the lowest height with a block time >= from_time.
+
+    Block times are not strictly increasing, blocks near the boundary with a
+    time before from_time are filtered out by date when counted.
+    """
+    low = 0
+    high = tip_height
+    while low < high:
+        mid = (low + high) // 2
+        if get_block_time(callrpc, mid) < from_time:
+            low = mid + 1
+        else:
+            high = mid
+    return low
+
+
+def count_days_parallel(callrpc, block_hash, num_days_to_count, num_workers, type_index=None):
+    """Resolve the height range up front and count blocks across a worker pool."""
+    header = callrpc('getblockheader', [block_hash])
+    tip_height = header['height']
+    tip_time = int(header['time'])
+    from_time = tip_time - tip_time % 86400 - (num_days_to_count - 1) * 86400
+    from_date = time.strftime('%Y-%m-%d', time.gmtime(from_time))
+
+    from_height = find_first_height(callrpc, from_time, tip_height)
+    print('Counting blocks {} to {} with {} workers'.format(from_height, tip_height, num_workers))
+
+    def process_height(height):
+        if height == tip_height:
+            height_hash = block_hash
+        else:
+            height_hash = callrpc('getblockhash', [height])
+        block_data = callrpc('getblock', [height_hash, 2])
+        return (block_date(block_data), ) + count_block_txns(callrpc, block_data, type_index)
+
+    day_counts = {}
+    pending_by_date = {}
+    total_txns = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=num_workers) as executor:
+        for date, block_counts, pending in executor.map(process_height, range(from_height, tip_height + 1)):
+            if date < from_date:
+                continue
+            if date not in day_counts:
+                day_counts[date] = [0, 0, 0, 0, 0]
+            add_counts(day_counts[date], block_counts)
+            if len(pending) > 0:
+                pending_by_date.setdefault(date, []).extend(pending)
+            total_txns += block_counts[0]
+            print('txns', total_txns, end='\r')
 
-            num_anon_in = 0
-            num_blind_in = 0
-            num_standard_in = 0
+    if type_index is not None:
+        count_pending_days(day_counts, pending_by_date, type_index)
 
-            num_anon_out = 0
-            num_blind_out = 0
-            num_standard_out = 0
+    # Match the order of the sequential walk, most recent first
+    return {k: day_counts[k] for k in sorted(day_counts, reverse=True)}
 
-            if tx['version'] == 672 and tx_i == 0:
-                day_cs_txns += 1
-                total_cs_txns += 1
-                continue
 
-            for txi_n, tx_input in enumerate(tx['vin']):
-                if 'coinbase' in tx_input:
-                    break
-                if 'type' in tx_input and tx_input['type'] == 'anon':
-                    num_anon_in += 1
-                    continue
+def make_boolean(v):
+    if isinstance(v, bool):
+        return v
+    if v.lower() in ('true', '1'):
+        return True
+    if v.lower() in ('false', '0'):
+        return False
+    raise argparse.ArgumentTypeError('Boolean value expected.')
 
-                prev_tx = json.loads(callrpc('getrawtransaction {} true'.format(tx_input['txid'])))
-                prevout = prev_tx['vout'][tx_input['vout']]
-                prevout_type = prevout['type']
 
-                if prevout_type == 'blind':
-                    num_blind_in += 1
-                else:
-                    num_standard_in += 1
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-v', '--version', action='version',
+                        version='%(prog)s {version}'.format(version=__version__))
+    parser.add_argument('--network', dest='network', default='')
+    parser.add_argument('--datadir', dest='datadir', help='Particl datadir (default=~/.particl)', default='~/.particl', required=False)
+    parser.add_argument('--days', dest='days', help='Number of days to count back', type=int, default=7, required=False)
+    parser.add_argument('--starthash', dest='starthash', help='Block hash to start from', default='', required=False)
+    parser.add_argument('--workers', dest='workers', help='Number of blocks to process in parallel, if > 1 the height range is resolved up front [1, 64] (default=1)', type=int, default=1, required=False)
+    parser.add_argument('--rpcport', dest='rpcport', help='RPC port, read from particl.conf or set to chain default if ommitted', type=int, default=0, required=False)
+    parser.add_argument('--usecli', dest='usecli', help='Call the daemon through particl-cli instead of JSON-RPC (default=false)', type=make_boolean, default=False, required=False)
+    parser.add_argument('--typeindex', dest='typeindex', help='Classify inputs from the outputs of scanned blocks, fetching older prevouts in batches (default=true)', type=make_boolean, default=True, required=False)
+    args = parser.parse_args()
 
-            for tx_out in tx['vout']:
-                tx_out_type = tx_out['type']
-                if tx_out_type == 'anon':
-                    num_anon_out += 1
-                elif tx_out_type == 'blind':
-                    num_blind_out += 1
-                elif tx_out_type == 'standard':
-                    num_standard_out += 1
-
-            if num_blind_out + num_blind_in > 0:
-                day_b_txns += 1
-                total_b_txns += 1
-
-            if num_anon_out + num_anon_in > 0:
-                day_a_txns += 1
-                total_a_txns += 1
-
-            if num_blind_out + num_blind_in + num_anon_out + num_anon_in == 0:
-                day_s_txns += 1
-                total_s_txns += 1
+    if args.workers < 1 or args.workers > 64:
+        raise argparse.ArgumentTypeError('Invalid workers')
 
-        block_hash = block_data['previousblockhash']
+    args.datadir = os.path.expanduser(args.datadir)
+
+    print('network', 'mainnet' if args.network == '' else args.network)
+
+    callrpc = make_rpc_func(args.datadir, args.network, rpc_port=args.rpcport, use_cli=args.usecli)
+
+    if args.starthash == '':
+        block_hash = callrpc('getbestblockhash')
+    else:
+        block_hash = args.starthash
+
+    print('Results from block', block_hash)
+
+    type_index = OutputTypeIndex(callrpc) if args.typeindex else None
+    if args.workers > 1:
+        days = count_days_parallel(callrpc, block_hash, args.days, args.workers, type_index)
+    else:
+        days = count_days(callrpc, block_hash, args.days, type_index)
 
+    totals = [0, 0, 0, 0, 0]
     output_fmt = '{:12}{:>12}{:>12}{:>12}{:>12}{:>12}'
     print(output_fmt.format('Date', 'All', 'Coinstake', 'Standard', 'Anon', 'Blind'))
     for k, v in days.items():
         print(output_fmt.format(k, v[0], v[1], v[2], v[3], v[4]))
+        add_counts(totals, v)
 
     print('')
-    print(output_fmt.format('Totals', total_txns, total_cs_txns, total_s_txns, total_a_txns, total_b_txns))
+    print(output_fmt.format('Totals', *totals))
 
     print('Done.')
 
@@ -11,27 +11,43 @@ Collect coldstaking disbursements in larger outputs
 $ export BIN_PATH=~/tmp/particl-0.21.2.7/bin
 $ ${BIN_PATH}/particl-qt -server -testnet
 $ python join_cs_disbursements.py --network=testnet --wallet=main_testnet_wallet.dat
+
+The daemon is called over JSON-RPC with the auth cookie from --datadir,
+particl-cli is used if --usecli is set or no cookie is found.
+
+After the first pass the script blocks in waitforblockheight until at least
+one new block exists and minblockdiff blocks have passed since the last payout.
+If --jitter is set a random delay between minwait and maxwait seconds is
+added after each new block.
 """
 
 __version__ = '0.2'
 
 import os
 import json
-import shlex
 import random
-import decimal
+import urllib
 import argparse
 import threading
 import subprocess
+from xmlrpc.client import (
+    Transport,
+    Fault,
+)
+from amount_util import (
+    COIN,
+    format8,
+    rpc_json_loads,
+)
 
 
 bin_path = os.path.join(os.path.expanduser(os.getenv('BIN_PATH', '')), 'particl-cli')
-decimal.getcontext().prec = 16
-COIN = 100000000
+DEFAULT_RPC_PORTS = {'mainnet': 51735, 'testnet': 51935, 'regtest': 51936}
+BLOCK_POLL_TIMEOUT = 60  # Seconds per waitforblockheight call
 
 
-low_filter = 100.0
-high_filter = 2000.0
+low_filter = 100 * COIN
+high_filter = 2000 * COIN
 
 
 class SkipIteration(Exception):
@@ -42,18 +58,95 @@ class NoneOutstanding(Exception):
     pass
 
 
-def dquantize(n, places=8):
-    return n.quantize(decimal.Decimal(10) ** -places)
+class Jsonrpc():
+    def __init__(self, uri, transport=None, encoding=None, verbose=False,
+                 allow_none=False, use_datetime=False, use_builtin_types=False,
+                 *, context=None):
+        self.request_id = 0
+        parsed = urllib.parse.urlparse(uri)
+        if parsed.scheme not in ('http', 'https'):
+            raise OSError('unsupported XML-RPC protocol')
+        self.__host = parsed.netloc
+        self.__handler = parsed.path
+        if not self.__handler:
+            self.__handler = '/RPC2'
+
+        if transport is None:
+            handler = Transport
+            extra_kwargs = {}
+            transport = handler(use_datetime=use_datetime,
+                                use_builtin_types=use_builtin_types,
+                                **extra_kwargs)
+        self.__transport = transport
+
+        self.__encoding = encoding or 'utf-8'
+        self.__verbose = verbose
+        self.__allow_none = allow_none
+
+    def close(self):
+        if self.__transport is not None:
+            self.__transport.close()
+
+    def json_request(self, method, params):
+        self.request_id += 1
+        request_body = {
+            'method': method,
+            'params': params,
+            'id': self.request_id
+        }
+        return self.post(request_body)
+
+    def json_batch_request(self, calls):
+        request_body = []
+        for method, params in calls:
+            self.request_id += 1
+            request_body.append({
+                'method': method,
+                'params': params,
+                'id': self.request_id
+            })
+        return self.post(request_body)
+
+    def post(self, request_body):
+        try:
+            connection = self.__transport.make_connection(self.__host)
+            headers = self.__transport._extra_headers[:]
+
+            connection.putrequest('POST', self.__handler)
+            headers.append(('Content-Type', 'application/json'))
+            headers.append(('User-Agent', 'jsonrpc'))
+            self.__transport.send_headers(connection, headers)
+            self.__transport.send_content(connection, json.dumps(request_body).encode('utf-8'))
+
+            resp = connection.getresponse()
+            return resp.read()
+
+        except Fault:
+            raise
+        except Exception:
+            # All unexpected errors leave connection in
+            # a strange state, so we clear it.
+            self.__transport.close()
+            raise
+
+
+def open_rpc(rpc_port, auth, wallet=None):
+    url = 'http://{}@127.0.0.1:{}/'.format(auth, rpc_port)
+    if wallet:
+        url += 'wallet/' + urllib.parse.quote(wallet)
+    return Jsonrpc(url)
 
 
-def callrpc(cmd, network='', wallet=''):
+def callcli(method, params=[], datadir=None, network=None, wallet=None):
     args = [bin_path, ]
 
-    if network:
+    if datadir:
+        args += ['--datadir=' + datadir, ]
+    if network and network != 'mainnet':
         args += ['--' + network, ]
     if wallet:
         args += ['--rpcwallet=' + wallet, ]
-    args += shlex.split(cmd)
+    args += [method, ] + [p if isinstance(p, str) else json.dumps(p) for p in params]
 
     p = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
 
@@ -62,101 +155,177 @@ def callrpc(cmd, network='', wallet=''):
     if len(out[1]) > 0:
         raise ValueError(out[1])
 
-    return out[0]
+    try:
+        return rpc_json_loads(out[0], [method])
+    except json.JSONDecodeError:
+        return out[0].decode('utf-8').strip()
 
 
-def get_sendcmd(data, ignore_set, args):
-    by_address = {}
-    total_by_address = {}
+def get_rpc_port(datadir, network):
+    configpath = os.path.join(datadir, 'particl.conf')
+    if os.path.exists(configpath):
+        with open(configpath) as fp:
+            for line in fp:
+                if line.startswith('#'):
+                    continue
+                pair = line.strip().split('=')
+                if len(pair) == 2 and pair[0] == 'rpcport':
+                    return int(pair[1])
+    return DEFAULT_RPC_PORTS['mainnet' if network == '' else network]
+
+
+def make_rpc_func(datadir, network, wallet=None, rpc_port=0, use_cli=False):
+    """Returns a function calling the daemon over JSON-RPC with cookie auth.
+
+    Each thread keeps its own persistent connection.
+    Falls back to running particl-cli if use_cli is set or no auth cookie is found.
+    rpc_func.batch sends a list of (method, params) pairs in one request and
+    returns a (result, error) pair for each.
+    """
+    rpc_auth = None
+    if not use_cli:
+        authcookiepath = os.path.join(datadir, '' if network in ('', 'mainnet') else network, '.cookie')
+        if os.path.exists(authcookiepath):
+            with open(authcookiepath) as fp:
+                rpc_auth = fp.read()
+        else:
+            print('Auth cookie not found, falling back to particl-cli:', authcookiepath)
+    if rpc_port == 0:
+        rpc_port = get_rpc_port(datadir, network)
+    thread_data = threading.local()
+
+    def post(rpc_wallet, methods, send):
+        if not hasattr(thread_data, 'conns'):
+            thread_data.conns = {}
+        for i in range(2):
+            if rpc_wallet not in thread_data.conns:
+                thread_data.conns[rpc_wallet] = open_rpc(rpc_port, rpc_auth, rpc_wallet)
+            try:
+                v = send(thread_data.conns[rpc_wallet])
+                break
+            except Exception as e:
+                # Reconnect once, the daemon may have closed an idle connection
+                thread_data.conns.pop(rpc_wallet).close()
+                if i > 0:
+                    raise ValueError('RPC Server Error ' + str(e))
+        return rpc_json_loads(v.decode('utf-8'), methods)
+
+    def rpc_func(method, params=[], wallet_override=None):
+        rpc_wallet = wallet if wallet_override is None else wallet_override
+        if rpc_auth is None:
+            return callcli(method, params, datadir, network, rpc_wallet)
+
+        r = post(rpc_wallet, [method], lambda conn: conn.json_request(method, params))
+        if 'error' in r and r['error'] is not None:
+            raise ValueError('RPC error ' + str(r['error']))
+        return r['result']
+
+    def rpc_batch(calls, wallet_override=None):
+        rpc_wallet = wallet if wallet_override is None else wallet_override
+        if rpc_auth is None:
+            rv = []
+            for method, params in calls:
+                try:
+                    rv.append((callcli(method, params, datadir, network, rpc_wallet), None))
+                except ValueError as e:
+                    rv.append((None, e))
+            return rv
+        if len(calls) < 1:
+            return []
+
+        r = post(rpc_wallet, [method for method, params in calls], lambda conn: conn.json_batch_request(calls))
+        if not isinstance(r, list):
+            if 'error' in r and r['error'] is not None:
+                raise ValueError('RPC error ' + str(r['error']))
+            raise ValueError('RPC error, unexpected batch response')
+        r.sort(key=lambda x: x['id'])
+        return [(rr.get('result', None), rr.get('error', None)) for rr in r]
+
+    rpc_func.batch = rpc_batch
+    return rpc_func
+
+
+def wait_for_height(callrpc, target_height, delay_event):
+    """Block until the chain reaches target_height, returns the new height."""
+    while not delay_event.is_set():
+        try:
+            r = callrpc('waitforblockheight', [target_height, BLOCK_POLL_TIMEOUT * 1000])
+        except Exception as e:
+            print('Error', e)
+            delay_event.wait(BLOCK_POLL_TIMEOUT)
+            continue
+        if r['height'] >= target_height:
+            return r['height']
+    return None
+
 
+def get_joins(data, ignore_set, args):
+    """Partition the unspent outputs into (anchor, to_join) pairs, at most args.maxjoins.
+
+    Each address's outputs are sorted once, coldstaking outputs valued in
+    [low_filter, high_filter) are anchors, smallest first, and take the next
+    inputlimit outputs below low_filter, smallest first.
+    """
+    by_address = {}
     for utxo in data:
         if args.testonly:
             outputid = utxo['txid'] + ',' + str(utxo['vout'])
             if outputid in ignore_set:
                 continue
-        utxo_list = by_address.get(utxo['address'], [])
-        utxo_list.append(utxo)
-        by_address[utxo['address']] = utxo_list
-
-        total = total_by_address.get(utxo['address'], [0, 0])
-        total[0] += 1
-        total[1] += utxo['amount']
-        total_by_address[utxo['address']] = total
-
-    cmd = 'sendtypeto part part "['
-    for addr, data in by_address.items():
-        print('\nAddress ', addr)
-        by_amount = sorted(data, key=lambda x: x['amount'])
-        totals = total_by_address[addr]
-        print(totals[0], totals[1])
-        print(len(data))
-
-        while True:
-            # From the lowest amount, find the first utxo < cutoff_amount
-            last_i = None
-            last_utxo = None
-            for i, utxo in enumerate(by_amount):
-                if utxo['amount'] < low_filter:
-                    continue
-                if utxo['amount'] >= high_filter:
-                    continue
-                if 'coldstaking_address' not in utxo:
-                    continue
-                last_i = i
-                last_utxo = utxo
+        by_address.setdefault(utxo['address'], []).append(utxo)
+
+    joins = []
+    for addr, utxos in by_address.items():
+        if len(joins) >= args.maxjoins:
+            break
+        small = []
+        anchors = []
+        for utxo in sorted(utxos, key=lambda x: x['amount']):
+            if utxo['amount'] < low_filter:
+                small.append(utxo)
+            elif utxo['amount'] < high_filter and 'coldstaking_address' in utxo:
+                anchors.append(utxo)
+        print('\nAddress {}, outputs {}, to join {}, anchors {}'.format(addr, len(utxos), len(small), len(anchors)))
+
+        i = 0
+        for anchor in anchors:
+            if i >= len(small) or len(joins) >= args.maxjoins:
                 break
-            print(last_i, last_utxo)
+            to_join = small[i: i + args.inputlimit]
+            i += len(to_join)
+            joins.append((anchor, to_join))
 
-            if last_i is None:
-                break
-            del by_amount[last_i]
-
-            total_out = decimal.Decimal(0)
-            to_join = []
-            for i in range(len(by_amount)):
-                utxo = by_amount[0]
-                if utxo['amount'] >= low_filter:
-                    break
-                to_join.append(utxo)
-                total_out += decimal.Decimal(utxo['amount'] * COIN)
-                del by_amount[0]
-
-                if len(to_join) >= args.inputlimit:
-                    break
-
-            if len(to_join) < 1:
-                break
-
-            total_out += decimal.Decimal(last_utxo['amount'] * COIN)
-            print('total_out', total_out)
-            cmd = 'sendtypeto part part "['
-            script_to = last_utxo['scriptPubKey']
-            cmd += '{\\"address\\":\\"script\\",\\"script\\":\\"' + script_to + '\\",\\"amount\\":' + str(dquantize(total_out / COIN)) + ',\\"subfee\\":true}]" '
-            cmd += '\\"\\" '    # comment
-            cmd += '\\"\\" '    # comment_to
-            cmd += '5 '         # ringsize
-            cmd += '1 '         # inputs_per_sig
-            if args.includewatchonly:
-                cmd += 'true '     # test_fee
-            else:
-                cmd += 'false '     # test_fee
-            cmd += '"{\\"inputs\\":['
-            cmd += '{\\"tx\\":\\"' + last_utxo['txid'] + '\\",\\"n\\":' + str(last_utxo['vout']) + '}'
-            for utxo in to_join:
-                cmd += ',{\\"tx\\":\\"' + utxo['txid'] + '\\",\\"n\\":' + str(utxo['vout']) + '}'
-
-            cmd += ']'
-            if args.includewatchonly:
-                cmd += ',\\"show_hex\\":true'
-                cmd += ',\\"includeWatching\\":true'
-            cmd += '}"'
             if args.testonly:
-                ignore_set.add(last_utxo['txid'] + ',' + str(last_utxo['vout']))
+                ignore_set.add(anchor['txid'] + ',' + str(anchor['vout']))
                 for utxo in to_join:
                     ignore_set.add(utxo['txid'] + ',' + str(utxo['vout']))
-
-            return cmd
-    raise NoneOutstanding
+    if len(joins) < 1:
+        raise NoneOutstanding
+    return joins
+
+
+def get_sendtypeto_params(anchor, to_join, args):
+    total_out = anchor['amount']
+    inputs = [{'tx': anchor['txid'], 'n': anchor['vout']}, ]
+    for utxo in to_join:
+        total_out += utxo['amount']
+        inputs.append({'tx': utxo['txid'], 'n': utxo['vout']})
+
+    options = {'inputs': inputs}
+    if args.includewatchonly:
+        options['show_hex'] = True
+        options['includeWatching'] = True
+    return [
+        'part',
+        'part',
+        [{'address': 'script', 'script': anchor['scriptPubKey'], 'amount': format8(total_out), 'subfee': True}],
+        '',  # comment
+        '',  # comment_to
+        5,  # ringsize
+        1,  # inputs_per_sig
+        args.includewatchonly,  # test_fee
+        options
+    ]
 
 
 def make_boolean(v):
@@ -175,11 +344,17 @@ def main():
                         version='%(prog)s {version}'.format(version=__version__))
     parser.add_argument('--network', dest='network', default='')
     parser.add_argument('--wallet', dest='wallet', default='')
-    parser.add_argument('--minwait', dest='minwait', help='Minimum number of seconds to wait before repeating [1, 3600] (default=60)', type=int, default=60, required=False)
-    parser.add_argument('--maxwait', dest='maxwait', help='Maximum number of seconds to wait before repeating [1, 7200] (default=600)', type=int, default=600, required=False)
+    parser.add_argument('--datadir', dest='datadir', help='Particl datadir (default=~/.particl)', default='~/.particl', required=False)
+    parser.add_argument('--rpcport', dest='rpcport', help='RPC port, read from particl.conf or set to chain default if ommitted', type=int, default=0, required=False)
+    parser.add_argument('--usecli', dest='usecli', help='Call the daemon through particl-cli instead of JSON-RPC (default=false)', type=make_boolean, default=False, required=False)
+    parser.add_argument('--jitter', dest='jitter', help='Wait a random number of seconds between minwait and maxwait before each pass (default=false)', type=make_boolean, default=False, required=False)
+    parser.add_argument('--minwait', dest='minwait', help='Minimum number of seconds to wait with --jitter [1, 3600] (default=60)', type=int, default=60, required=False)
+    parser.add_argument('--maxwait', dest='maxwait', help='Maximum number of seconds to wait with --jitter [1, 7200] (default=600)', type=int, default=600, required=False)
     parser.add_argument('--testonly', dest='testonly', help='If true sendtypeto command will not be run on daemon (default=false)', type=make_boolean, default=False, required=False)
     parser.add_argument('--includewatchonly', dest='includewatchonly', help='Construct sendtypeto command with "includeWatching" set (default=false)', type=make_boolean, default=False, required=False)
     parser.add_argument('--minblockdiff', dest='minblockdiff', help='Minimum number of blocks to wait before repeating [0, 600] (default=1)', type=int, default=1, required=False)
+    parser.add_argument('--maxjoins', dest='maxjoins', help='Maximum number of transactions to create per pass [1, 1000] (default=10)', type=int, default=10, required=False)
+    parser.add_argument('--batchsize', dest='batchsize', help='Number of transactions to submit per JSON-RPC request [1, 100] (default=1)', type=int, default=1, required=False)
     parser.add_argument('--inputlimit', dest='inputlimit', help='Maximum number of outputs to join per transaction [1, 600] (default=60)', type=int, default=60, required=False)
     args = parser.parse_args()
 
@@ -191,27 +366,45 @@ def main():
         raise argparse.ArgumentTypeError('Invalid minblockdiff')
     if args.inputlimit < 1 or args.inputlimit > 600:
         raise argparse.ArgumentTypeError('Invalid inputlimit')
+    if args.maxjoins < 1 or args.maxjoins > 1000:
+        raise argparse.ArgumentTypeError('Invalid maxjoins')
+    if args.batchsize < 1 or args.batchsize > 100:
+        raise argparse.ArgumentTypeError('Invalid batchsize')
+
+    args.datadir = os.path.expanduser(args.datadir)
 
     print('network', 'mainnet' if args.network == '' else args.network)
 
+    callrpc = make_rpc_func(args.datadir, args.network, args.wallet, rpc_port=args.rpcport, use_cli=args.usecli)
+
     delay_event = threading.Event()
 
     ignore_set = set()
     last_height = 0
+    height = 0
     while True:
-        data = json.loads(callrpc('listunspent', args.network, args.wallet))
+        data = callrpc('listunspent')
 
         try:
-            height = int(callrpc('getblockcount', args.network, args.wallet))
+            height = callrpc('getblockcount')
             if height - last_height < args.minblockdiff:
                 print('Blocks since last payout less than minblockdiff setting:', height - last_height)
                 raise SkipIteration
-            cmd = get_sendcmd(data, ignore_set, args)
+            joins = get_joins(data, ignore_set, args)
             print('\nChain Height', height)
-            print('Command', cmd)
             last_height = height
+            calls = []
+            for anchor, to_join in joins:
+                params = get_sendtypeto_params(anchor, to_join, args)
+                print('Join {} inputs to {},{}, amount {}'.format(len(to_join) + 1, anchor['txid'], anchor['vout'], params[2][0]['amount']))
+                calls.append(('sendtypeto', params))
             if not args.testonly:
-                callrpc(cmd, args.network, args.wallet)
+                for i in range(0, len(calls), args.batchsize):
+                    for result, error in callrpc.batch(calls[i: i + args.batchsize]):
+                        if error is not None:
+                            print('Error', error)
+                        else:
+                            print('Sent', result)
         except NoneOutstanding:
             print('Nothing to do.')
         except SkipIteration:
@@ -219,9 +412,17 @@ def main():
         except Exception as e:
             print('Error', e)
 
-        wait_for = random.randint(args.minwait, args.maxwait)
-        print('Waiting for {} seconds'.format(wait_for))
-        delay_event.wait(wait_for)
+        # New disbursements arrive in blocks, wait for the next block and until minblockdiff is reached
+        target_height = max(height + 1, last_height + args.minblockdiff)
+        print('Waiting for block {}'.format(target_height))
+        height = wait_for_height(callrpc, target_height, delay_event)
+        if height is None:
+            break
+
+        if args.jitter:
+            wait_for = random.randint(args.minwait, args.maxwait)
+            print('Waiting for {} seconds'.format(wait_for))
+            delay_event.wait(wait_for)
 
     print('Done.')
 
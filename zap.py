@@ -22,6 +22,10 @@ Once a transaction has been created the script will wait for a random
 interval between "minwait" and "maxwait" seconds and repeat until no
 unspent p2pkh outputs are found.
 
+The unspent outputs are kept between loops and updated from listsinceblock,
+the full list is fetched again every "resyncevery" loops or if a change
+can't be applied, a spend from outside the script for example.
+
 The wallet must remain unlocked while the script is running.
 
 
@@ -33,6 +37,12 @@ Start Particl Desktop
 Test first:
 ./zap.py --rpcwallet=wallet.dat --minwait=1 --maxwait=5 --testonly=1
 
+Print a plan of all the transactions needed, without sending any:
+./zap.py --rpcwallet=wallet.dat --nomix=true --plan=true
+
+Create and test all the transactions needed against the mempool, without sending any:
+./zap.py --rpcwallet=wallet.dat --nomix=true --simulate=true
+
 Send to a specific stakeaddress:
 ./zap.py --rpcwallet=wallet.dat --nomix=true pcs19453kf98kz47yktqv7x36j39xa07mtvqx8evse
 """
@@ -43,28 +53,34 @@ import os
 import sys
 import json
 import random
+import heapq
 import signal
 import urllib
-import decimal
 import logging
 import argparse
 import threading
+import concurrent.futures
 from xmlrpc.client import (
     Transport,
     Fault,
 )
+from amount_util import (
+    format8,
+    parse_amount,
+    rpc_json_loads,
+)
 
-COIN = 100000000
+# Estimated transaction sizes in bytes, fees scale with the total
+TX_BASE_SIZE = 12
+TX_INPUT_SIZE = 149
+TX_CS_OUTPUT_SIZE = 80
+# Simulation mode sends calls in batches of SIMULATE_BATCH_SIZE, SIMULATE_WORKERS batches at a time
+SIMULATE_BATCH_SIZE = 20
+SIMULATE_WORKERS = 4
 delay_event = threading.Event()
 logging.basicConfig(stream=sys.stdout, level=logging.INFO, format='%(message)s')
 
 
-def jsonDecimal(obj):
-    if isinstance(obj, decimal.Decimal):
-        return str(obj)
-    raise TypeError
-
-
 class Jsonrpc():
     def __init__(self, uri, transport=None, encoding=None, verbose=False,
                  allow_none=False, use_datetime=False, use_builtin_types=False,
@@ -95,22 +111,35 @@ class Jsonrpc():
             self.__transport.close()
 
     def json_request(self, method, params):
-        try:
-            connection = self.__transport.make_connection(self.__host)
-            headers = self.__transport._extra_headers[:]
+        self.request_id += 1
+        request_body = {
+            'method': method,
+            'params': params,
+            'id': self.request_id
+        }
+        return self.post(request_body)
 
+    def json_batch_request(self, calls):
+        request_body = []
+        for method, params in calls:
             self.request_id += 1
-            request_body = {
+            request_body.append({
                 'method': method,
                 'params': params,
                 'id': self.request_id
-            }
+            })
+        return self.post(request_body)
+
+    def post(self, request_body):
+        try:
+            connection = self.__transport.make_connection(self.__host)
+            headers = self.__transport._extra_headers[:]
 
             connection.putrequest('POST', self.__handler)
             headers.append(('Content-Type', 'application/json'))
             headers.append(('User-Agent', 'jsonrpc'))
             self.__transport.send_headers(connection, headers)
-            self.__transport.send_content(connection, json.dumps(request_body, default=jsonDecimal).encode('utf-8'))
+            self.__transport.send_content(connection, json.dumps(request_body).encode('utf-8'))
 
             resp = connection.getresponse()
             return resp.read()
@@ -132,7 +161,7 @@ def callrpc(rpc_port, auth, method, params=[], wallet=None):
         x = Jsonrpc(url)
         v = x.json_request(method, params)
         x.close()
-        r = json.loads(v.decode('utf-8'))
+        r = rpc_json_loads(v.decode('utf-8'), [method])
     except Exception as e:
         raise ValueError('RPC Server Error' + str(e))
 
@@ -141,18 +170,30 @@ def callrpc(rpc_port, auth, method, params=[], wallet=None):
     return r['result']
 
 
-def make_int(value):
-    return int(decimal.Decimal(value) * decimal.Decimal(COIN))
+def callrpc_batch(rpc_port, auth, calls, wallet=None):
+    """Send a list of (method, params) pairs in one request.
 
+    Returns a (result, error) pair for each call in order, so one failed call doesn't hide the others.
+    """
+    if len(calls) < 1:
+        return []
+    try:
+        url = 'http://{}@127.0.0.1:{}/'.format(auth, rpc_port)
+        if wallet is not None:
+            url += 'wallet/' + urllib.parse.quote(wallet)
+        x = Jsonrpc(url)
+        v = x.json_batch_request(calls)
+        x.close()
+        r = rpc_json_loads(v.decode('utf-8'), [method for method, params in calls])
+    except Exception as e:
+        raise ValueError('RPC Server Error' + str(e))
 
-def format8(i):
-    n = abs(i)
-    quotient = n // COIN
-    remainder = n % COIN
-    rv = '%d.%08d' % (quotient, remainder)
-    if i < 0:
-        rv = '-' + rv
-    return rv
+    if not isinstance(r, list):
+        if 'error' in r and r['error'] is not None:
+            raise ValueError('RPC error ' + str(r['error']))
+        raise ValueError('RPC error, unexpected batch response')
+    r.sort(key=lambda x: x['id'])
+    return [(rr.get('result', None), rr.get('error', None)) for rr in r]
 
 
 def make_boolean(v):
@@ -165,6 +206,83 @@ def make_boolean(v):
     raise argparse.ArgumentTypeError('Boolean value expected.')
 
 
+def estimate_tx_size(num_inputs):
+    return TX_BASE_SIZE + num_inputs * TX_INPUT_SIZE + TX_CS_OUTPUT_SIZE
+
+
+def plan_group_greedy(txos, maxinputs, maxvalue):
+    """Split (amount, position, txo) tuples into transactions, an upper bound for plan_group.
+
+    Like selectInputs the last input added may take a transaction over maxvalue,
+    so each transaction is filled with the smallest outputs and closed with the largest.
+    """
+    txos = sorted(txos, key=lambda x: x[:2])
+    txns = []
+    lo = 0
+    hi = len(txos) - 1
+    while lo <= hi:
+        tx = []
+        total_value = 0
+        while len(tx) < maxinputs - 1 and lo < hi and total_value + txos[lo][0] < maxvalue:
+            tx.append(txos[lo])
+            total_value += txos[lo][0]
+            lo += 1
+        tx.append(txos[hi])
+        hi -= 1
+        txns.append(tx)
+    return txns
+
+
+def pack_closers(txos, num_txns, maxinputs, maxvalue):
+    # txos sorted largest first, the num_txns largest close a transaction each and the
+    # rest are packed first fit below maxvalue, returns None if they don't fit
+    bins = [[] for i in range(num_txns)]
+    totals = [0] * num_txns
+    smallest = txos[-1][0]
+    open_bins = [i for i in range(num_txns) if maxinputs > 1]
+    for txo in txos[num_txns:]:
+        for j, i in enumerate(open_bins):
+            if totals[i] + txo[0] < maxvalue:
+                bins[i].append(txo)
+                totals[i] += txo[0]
+                if len(bins[i]) >= maxinputs - 1 or totals[i] + smallest >= maxvalue:
+                    del open_bins[j]
+                break
+        else:
+            return None
+    return [bins[i][::-1] + [txos[i]] for i in range(num_txns)]
+
+
+def plan_group(txos, maxinputs, maxvalue):
+    """Split (amount, position, txo) tuples into as few transactions as found.
+
+    A transaction is valid if it has at most maxinputs inputs and the inputs before
+    the largest sum to less than maxvalue, as selectInputs adds them.
+    k transactions are closed by the k largest outputs and the rest packed first fit
+    decreasing, k is bisected between plan_lower_bound and plan_group_greedy.
+    First fit may miss a packing, so the result can still be above the minimum.
+    """
+    txns = plan_group_greedy(txos, maxinputs, maxvalue)
+    txos = sorted(txos, key=lambda x: x[:2], reverse=True)
+    lo = plan_lower_bound(txos, maxinputs, maxvalue)
+    hi = len(txns)
+    while lo < hi:
+        num_txns = (lo + hi) // 2
+        packed = pack_closers(txos, num_txns, maxinputs, maxvalue)
+        if packed is None:
+            lo = num_txns + 1
+        else:
+            txns = packed
+            hi = num_txns
+    return txns
+
+
+def plan_lower_bound(txos, maxinputs, maxvalue):
+    # A transaction can't hold more than maxinputs inputs, or more than one input >= maxvalue
+    num_large = sum(1 for txo in txos if txo[0] >= maxvalue)
+    return max((len(txos) + maxinputs - 1) // maxinputs, num_large)
+
+
 def signal_handler(sig, frame):
     logging.info('Signal {} detected, ending.'.format(sig))
     delay_event.set()
@@ -186,12 +304,109 @@ class Prevout():
         return self.txid == other.txid and self.n == other.n
 
 
+class GroupSelection():
+    """Walks the groups of a Zapper's view by total value, and their outputs by amount, smallest first.
+
+    Entries are popped from the view's heaps as they are passed, restore() puts back
+    the ones still in the view.  Stale entries left by removeUtxo are dropped on the way.
+    """
+    __slots__ = ('zapper', 'addr', 'visited', 'popped_groups', 'popped_txos')
+
+    def __init__(self, zapper):
+        self.zapper = zapper
+        self.addr = None
+        self.visited = set()
+        self.popped_groups = []
+        self.popped_txos = []
+
+    def currentGroup(self):
+        if self.addr is not None:
+            return self.addr
+        zapper = self.zapper
+        while len(zapper.group_order) > 0:
+            entry = heapq.heappop(zapper.group_order)
+            total_value, seq, addr = entry
+            if zapper.group_seqs.get(addr) != seq or zapper.group_totals[addr] != total_value or addr in self.visited:
+                continue
+            self.visited.add(addr)
+            self.popped_groups.append(entry)
+            self.addr = addr
+            return addr
+        return None
+
+    def nextGroup(self):
+        self.addr = None
+
+    def hasTxo(self):
+        txos = self.zapper.group_heaps.get(self.addr)
+        if txos is None:
+            return False
+        positions = self.zapper.positions
+        while len(txos) > 0:
+            if txos[0][1] in positions:
+                return True
+            heapq.heappop(txos)
+        return False
+
+    def popTxo(self):
+        # Returns None once the current group is used up
+        txos = self.zapper.group_heaps.get(self.addr)
+        if txos is None:
+            return None
+        positions = self.zapper.positions
+        while len(txos) > 0:
+            entry = heapq.heappop(txos)
+            if entry[1] in positions:
+                self.popped_txos.append((self.addr, entry))
+                return positions[entry[1]]
+        return None
+
+    def isEmpty(self):
+        while self.currentGroup() is not None:
+            if self.hasTxo():
+                return False
+            self.nextGroup()
+        return True
+
+    def restore(self):
+        zapper = self.zapper
+        for entry in self.popped_groups:
+            total_value, seq, addr = entry
+            if zapper.group_seqs.get(addr) == seq and zapper.group_totals[addr] == total_value:
+                heapq.heappush(zapper.group_order, entry)
+        for addr, entry in self.popped_txos:
+            if entry[1] in zapper.positions:
+                heapq.heappush(zapper.group_heaps[addr], entry)
+        self.addr = None
+        self.visited.clear()
+        self.popped_groups = []
+        self.popped_txos = []
+
+
 class Zapper():
     def __init__(self, settings):
         self.settings = settings
         self.rpc_conn = None
         self.used_outputs = set()  # Store used outputs for test only mode
         self.num_derived = 0
+        self.internal_chain = None
+
+        # Local view of the wallet's unspent outputs
+        self.utxos = None  # Prevout -> (amount, listunspent entry)
+        self.utxos_by_address = {}  # Address -> set of prevouts
+        self.groups = {}  # Selectable outputs by address or grouping, Prevout -> (amount, position, listunspent entry)
+        self.group_totals = {}
+        self.group_heaps = {}  # Heaps of (amount, position), kept across loops
+        self.positions = {}  # Position -> (amount, position, listunspent entry) of the outputs in groups
+        self.group_seqs = {}  # Breaks ties in group_order by the order groups were created
+        self.group_order = []  # Heap of (total value, seq, group)
+        self.num_added = 0
+        self.num_groups = 0
+        self.num_stale = 0  # Entries in the heaps no longer in the view
+        self.last_block = None
+        self.own_txids = set()  # Txns sent by the script since the last full sync
+        self.address_groups = {}
+        self.num_zaps = 0
         self.wallet = None if self.settings.rpcwallet == '' else self.settings.rpcwallet
 
         logging.info('Network: {}'.format(self.settings.network))
@@ -215,6 +430,13 @@ class Zapper():
     def callrpc(self, method, params=[]):
         return callrpc(self.settings.rpcport, self.rpc_auth, method, params, self.wallet)
 
+    def callrpcBatches(self, calls):
+        # Returns a (result, error) pair per call, batches are sent concurrently
+        batches = [calls[i: i + SIMULATE_BATCH_SIZE] for i in range(0, len(calls), SIMULATE_BATCH_SIZE)]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=SIMULATE_WORKERS) as executor:
+            results = executor.map(lambda batch: callrpc_batch(self.settings.rpcport, self.rpc_auth, batch, self.wallet), batches)
+            return [r for batch_results in results for r in batch_results]
+
     def waitForDaemonRPC(self, num_tries=10):
         for i in range(num_tries + 1):
             if delay_event.is_set():
@@ -257,6 +479,14 @@ class Zapper():
         r = self.callrpc('validateaddress', [self.settings.stakeaddress])
         assert(r['isvalid'] is True), 'Invalid stakeaddress'
 
+        if self.settings.plan:
+            self.planZaps()
+            return
+
+        if self.settings.simulate:
+            self.simulateZaps()
+            return
+
         while True:
             if delay_event.is_set():
                 return
@@ -281,77 +511,315 @@ class Zapper():
                     logging.info('{}/{} seconds...'.format(delayed, delay_for))
                 delayed += delay_step
 
-    def selectInputs(self, groups, group_totals):
+    def getAddressGroups(self):
+        address_groups = {}
+        if self.settings.addressgroupings:
+            ags = self.callrpc('listaddressgroupings')
+            for ag in ags:
+                if len(ag) < 2:
+                    continue
+                grouping_name = 'group_{:03d}'.format(len(address_groups))
+                for a in ag:
+                    # [addr, balance]
+                    address_groups[a[0]] = grouping_name
+        return address_groups
+
+    def addUtxo(self, prevout, amount, txo):
+        self.utxos[prevout] = (amount, txo)
+        address = txo.get('address')
+        if address is not None:
+            self.utxos_by_address.setdefault(address, set()).add(prevout)
+        if prevout in self.used_outputs:
+            return
+        if 'coldstaking_address' in txo:
+            return
+        if address is None or not txo['desc'].startswith('pkh('):
+            return
+        addr = self.address_groups.get(address, address)
+        if addr not in self.groups:
+            self.groups[addr] = {}
+            self.group_totals[addr] = 0
+            self.group_heaps[addr] = []
+            self.group_seqs[addr] = self.num_groups
+            self.num_groups += 1
+        else:
+            self.num_stale += 1  # The group's last entry in group_order
+        # position keeps equal amounts in listunspent order
+        self.groups[addr][prevout] = (amount, self.num_added, txo)
+        self.positions[self.num_added] = self.groups[addr][prevout]
+        heapq.heappush(self.group_heaps[addr], (amount, self.num_added))
+        self.num_added += 1
+        self.group_totals[addr] += amount
+        heapq.heappush(self.group_order, (self.group_totals[addr], self.group_seqs[addr], addr))
+
+    def removeUtxo(self, prevout):
+        amount, txo = self.utxos.pop(prevout, (0, None))
+        if txo is None:
+            return
+        address = txo.get('address')
+        if address is None:
+            return
+        self.utxos_by_address[address].discard(prevout)
+        if len(self.utxos_by_address[address]) < 1:
+            del self.utxos_by_address[address]
+        addr = self.address_groups.get(address, address)
+        if addr not in self.groups or prevout not in self.groups[addr]:
+            return
+        del self.positions[self.groups[addr].pop(prevout)[1]]
+        self.group_totals[addr] -= amount
+        self.num_stale += 1  # The group's last entry in group_order
+        if len(self.groups[addr]) < 1:
+            del self.groups[addr]
+            del self.group_totals[addr]
+            del self.group_heaps[addr]
+            del self.group_seqs[addr]
+        else:
+            self.num_stale += 1  # The output's entry in the group's heap
+            heapq.heappush(self.group_order, (self.group_totals[addr], self.group_seqs[addr], addr))
+
+    def compactGroups(self):
+        # Drop the stale heap entries once they outnumber the outputs in the view, not while a GroupSelection is open
+        if self.num_stale <= len(self.utxos):
+            return
+        for addr, group in self.groups.items():
+            self.group_heaps[addr] = [(amount, position) for amount, position, txo in group.values()]
+            heapq.heapify(self.group_heaps[addr])
+        self.group_order = [(total_value, self.group_seqs[addr], addr) for addr, total_value in self.group_totals.items()]
+        heapq.heapify(self.group_order)
+        self.num_stale = 0
+
+    def rebuildGroups(self, utxos):
+        self.utxos = {}
+        self.utxos_by_address = {}
+        self.groups = {}
+        self.group_totals = {}
+        self.group_heaps = {}
+        self.positions = {}
+        self.group_seqs = {}
+        self.group_order = []
+        self.num_added = 0
+        self.num_groups = 0
+        self.num_stale = 0
+        for prevout, (amount, txo) in utxos:
+            self.addUtxo(prevout, amount, txo)
+
+    def fullSyncUtxos(self):
+        # Get the best block first, changes between the calls will be seen by the next update
+        self.last_block = self.callrpc('getbestblockhash')
+        utxos = self.callrpc('listunspent')
+        self.own_txids.clear()
+        self.address_groups = self.getAddressGroups()
+        self.rebuildGroups([(Prevout(txo['txid'], txo['vout']), (txo['amount'], txo)) for txo in utxos])
+
+    def updateUtxos(self):
+        # Returns False if the changes since the last sync can't be applied to the view
+        try:
+            r = self.callrpc('listsinceblock', [self.last_block, 1, False, True])
+        except Exception as ex:
+            logging.warning('listsinceblock failed: {}'.format(ex))
+            return False
+        if len(r.get('removed', [])) > 0:
+            return False
+
+        changed_addrs = set()
+        for tx in r['transactions']:
+            if tx['txid'] in self.own_txids:
+                continue
+            if tx['category'] != 'receive' or 'address' not in tx:
+                return False
+            changed_addrs.add(tx['address'])
+
+        if len(changed_addrs) > 0:
+            for address in changed_addrs:
+                for prevout in list(self.utxos_by_address.get(address, ())):
+                    self.removeUtxo(prevout)
+            for txo in self.callrpc('listunspent', [1, 9999999, sorted(changed_addrs)]):
+                self.addUtxo(Prevout(txo['txid'], txo['vout']), txo['amount'], txo)
+            if self.settings.addressgroupings:
+                # Groupings may have merged
+                self.address_groups = self.getAddressGroups()
+                self.rebuildGroups(list(self.utxos.items()))
+        self.last_block = r['lastblock']
+        return True
+
+    def selectInputs(self, selection):
+        # selection is a GroupSelection over the view, groups are taken by total value, outputs by amount, smallest first
         total_value = 0
         selected = []
-        addrs = sorted(group_totals, key=group_totals.get)
-        for addr in addrs:
-            txos = groups[addr]
+        while selection.currentGroup() is not None:
             while True:
-                if len(txos) < 1:
-                    del groups[addr]
-                    del group_totals[addr]
-                    break
                 if len(selected) >= self.settings.maxinputs or \
                    total_value >= self.settings.maxvalue:
-                    return total_value, selected
-                try:
-                    txo = txos.pop()
-                except Exception:
-                    continue
-                total_value += make_int(txo['amount'])
+                    if selection.hasTxo():
+                        return total_value, selected
+                    selection.nextGroup()
+                    break
+                r = selection.popTxo()
+                if r is None:
+                    selection.nextGroup()
+                    break
+                amount, position, txo = r
+                total_value += amount
                 selected.append(txo)
 
             if self.settings.nomix or self.settings.addressgroupings:
                 return total_value, selected
         return total_value, selected
 
-    def zap(self):
-        utxos = self.callrpc('listunspent')
+    def planZaps(self):
+        self.fullSyncUtxos()
 
-        address_groups = {}
-        if self.settings.addressgroupings:
-            ags = self.callrpc('listaddressgroupings')
-            for ag in ags:
-                if len(ag) < 2:
+        if self.settings.nomix or self.settings.addressgroupings:
+            plan_groups = {addr: list(group.values()) for addr, group in self.groups.items()}
+        else:
+            plan_groups = {'mixed': [txo for group in self.groups.values() for txo in group.values()]}
+
+        logging.info('Plan, dry run:')
+        num_txns = 0
+        num_inputs = 0
+        total_size = 0
+        lower_bound = 0
+        num_dust_txns = 0
+        for addr, txos in plan_groups.items():
+            lower_bound += plan_lower_bound(txos, self.settings.maxinputs, self.settings.maxvalue)
+            for tx in plan_group(txos, self.settings.maxinputs, self.settings.maxvalue):
+                total_value = sum(txo[0] for txo in tx)
+                if total_value < self.settings.minvalue:
+                    num_dust_txns += 1
+                    logging.info('  {}: inputs {}, value {}, below minvalue, skipped.'.format(addr, len(tx), format8(total_value)))
                     continue
-                grouping_name = 'group_{:03d}'.format(len(address_groups))
-                for a in ag:
-                    # [addr, balance]
-                    address_groups[a[0]] = grouping_name
-
-        # Group by address
-        group_totals = {}
-        groups = {}
-        for txo in utxos:
-            if Prevout(txo['txid'], txo['vout']) in self.used_outputs:
+                num_txns += 1
+                num_inputs += len(tx)
+                total_size += estimate_tx_size(len(tx))
+                logging.info('  {}: inputs {}, value {}, est. size {}.'.format(addr, len(tx), format8(total_value), estimate_tx_size(len(tx))))
+
+        logging.info('Planned txns: {}, lower bound {}, inputs {}, est. total size {}, skipped below minvalue {}.'.format(
+                     num_txns, lower_bound, num_inputs, total_size, num_dust_txns))
+
+        # The schedule the loop would create, for comparison
+        selection = GroupSelection(self)
+        num_loop_txns = 0
+        num_loop_inputs = 0
+        loop_size = 0
+        while True:
+            total_value, inputs = self.selectInputs(selection)
+            if len(inputs) < 1:
+                break
+            if total_value < self.settings.minvalue:
                 continue
-            if 'coldstaking_address' in txo:
+            num_loop_txns += 1
+            num_loop_inputs += len(inputs)
+            loop_size += estimate_tx_size(len(inputs))
+        selection.restore()
+        logging.info('Loop txns: {}, inputs {}, est. total size {}.'.format(num_loop_txns, num_loop_inputs, loop_size))
+
+    def getInternalChain(self):
+        if self.internal_chain is None:
+            account = self.callrpc('extkey', ['account'])
+            for c in account['chains']:
+                if 'function' in c and c['function'] == 'active_internal':
+                    self.internal_chain = c['chain']
+                    self.num_derived = int(c['num_derives'])
+                    break
+            if self.internal_chain is None:
+                raise ValueError('No active internal chain found')
+        return self.internal_chain
+
+    def deriveSpendAddresses(self, num_addresses):
+        # Unsaved addresses from the internal chain, for transactions that won't be submitted
+        internal_chain = self.getInternalChain()
+        r = self.callrpc('deriverangekeys', [self.num_derived, self.num_derived + num_addresses - 1, internal_chain, False, False, False, True])
+        self.num_derived += num_addresses
+        return r
+
+    def makeSendParams(self, total_value, cc_inputs, spend_address, submit_tx, show_fee=False):
+        options = {
+            'inputs': cc_inputs,
+            'test_mempool_accept': True,
+            'submit_tx': submit_tx,
+            'show_hex': True,
+        }
+        if show_fee:
+            options['show_fee'] = True
+        return [
+            'part',
+            'part',
+            [{'amount': format8(total_value), 'address': spend_address, 'stakeaddress': self.settings.stakeaddress, 'subfee': True}],
+            '', '', 5, 1, False, options
+        ]
+
+    def simulateZaps(self):
+        # Build every transaction the loop would create and test them all against the mempool, nothing is sent
+        self.fullSyncUtxos()
+
+        selection = GroupSelection(self)
+        candidates = []
+        num_dust_txns = 0
+        while True:
+            total_value, inputs = self.selectInputs(selection)
+            if len(inputs) < 1:
+                break
+            if total_value < self.settings.minvalue:
+                num_dust_txns += 1
                 continue
-            if not txo['desc'].startswith('pkh('):
+            candidates.append((total_value, [{'tx': tx['txid'], 'n': tx['vout']} for tx in inputs]))
+        selection.restore()
+
+        if len(candidates) < 1:
+            logging.info('No valid inputs')
+            return
+
+        logging.info('Simulating {} txns.'.format(len(candidates)))
+        spend_addresses = self.deriveSpendAddresses(len(candidates))
+        calls = []
+        for (total_value, cc_inputs), spend_address in zip(candidates, spend_addresses):
+            calls.append(('sendtypeto', self.makeSendParams(total_value, cc_inputs, spend_address, False, show_fee=True)))
+        sent = self.callrpcBatches(calls)
+
+        accepted = []
+        num_rejected = 0
+        for (total_value, cc_inputs), (rv, error) in zip(candidates, sent):
+            if error is not None:
+                num_rejected += 1
+                logging.info('  Rejected: inputs {}, value {}, {}.'.format(len(cc_inputs), format8(total_value), error.get('message', error)))
                 continue
-            addr = address_groups.get(txo['address'], txo['address'])
-            if addr not in groups:
-                groups[addr] = []
-
-            # Sort from largest to smallest, selectInputs pops the list
-            inserted = False
-            for i in range(len(groups[addr])):
-                if make_int(txo['amount']) >= make_int(groups[addr][i]['amount']):
-                    groups[addr].insert(i, txo)
-                    inserted = True
-                    break
-            if not inserted:
-                groups[addr].append(txo)
-            group_totals[addr] = group_totals.get(addr, 0) + make_int(txo['amount'])
+            accepted.append((total_value, cc_inputs, rv))
+
+        decoded = self.callrpcBatches([('decoderawtransaction', [rv['hex'], ]) for _, _, rv in accepted])
+        num_inputs = 0
+        total_size = 0
+        total_fee = 0
+        total_value = 0
+        for (value, cc_inputs, rv), (tx, error) in zip(accepted, decoded):
+            if error is not None:
+                raise ValueError('decoderawtransaction failed: ' + str(error))
+            num_inputs += len(cc_inputs)
+            total_size += tx.get('vsize', tx['size'])
+            total_fee += rv['fee']
+            total_value += value
+
+        logging.info('Accepted txns: {}, rejected {}, skipped below minvalue {}.'.format(len(accepted), num_rejected, num_dust_txns))
+        logging.info('Inputs: {}, total size {}, total fee {}, total value {}.'.format(num_inputs, total_size, format8(total_fee), format8(total_value)))
 
-        if len(groups) < 1:
+    def zap(self):
+        if self.utxos is None or self.num_zaps % self.settings.resyncevery == 0:
+            self.fullSyncUtxos()
+        elif not self.updateUtxos():
+            logging.info('Resyncing unspent outputs')
+            self.fullSyncUtxos()
+        self.num_zaps += 1
+
+        if len(self.groups) < 1:
             logging.info('No valid inputs')
             return False
 
+        # Select from the heaps kept with the view, outputs passed over are put back by restore
+        self.compactGroups()
+        selection = GroupSelection(self)
         while True:
-            total_value, inputs = self.selectInputs(groups, group_totals)
+            total_value, inputs = self.selectInputs(selection)
             if len(inputs) < 1:
+                selection.restore()
                 logging.info('No valid inputs')
                 return False
 
@@ -359,21 +827,13 @@ class Zapper():
                 logging.info('Skipping inputs below dust value')
                 continue
             break
+        sent_all = selection.isEmpty()
+        selection.restore()
 
-        internal_chain = ''
-        account = self.callrpc('extkey', ['account'])
-        for c in account['chains']:
-            if 'function' in c and c['function'] == 'active_internal':
-                internal_chain = c['chain']
-                if self.settings.testonly:
-                    if self.num_derived == 0:
-                        self.num_derived = int(c['num_derives'])
-                    r = self.callrpc('deriverangekeys', [self.num_derived, self.num_derived, internal_chain, False, False, False, True])
-                    spend_address = r[0]
-                    self.num_derived += 1
-                else:
-                    spend_address = internal_chain
-                break
+        if self.settings.testonly:
+            spend_address = self.deriveSpendAddresses(1)[0]
+        else:
+            spend_address = self.getInternalChain()
 
         addressinfo = self.callrpc('getaddressinfo', [spend_address])
         assert(addressinfo['ismine'] is True), 'Unowned spendaddress'
@@ -382,32 +842,29 @@ class Zapper():
         for tx in inputs:
             if self.settings.testonly:
                 self.used_outputs.add(Prevout(tx['txid'], tx['vout']))
+                self.removeUtxo(Prevout(tx['txid'], tx['vout']))
             cc_inputs.append({'tx': tx['txid'], 'n': tx['vout']})
 
-        options = {
-            'inputs': cc_inputs,
-            'test_mempool_accept': True,
-            'submit_tx': not self.settings.testonly,
-            'show_hex': True,
-        }
-        params = [
-            'part',
-            'part',
-            [{'amount': format8(total_value), 'address': spend_address, 'stakeaddress': self.settings.stakeaddress, 'subfee': True}],
-            '', '', 5, 1, False, options
-        ]
-        rv = self.callrpc('sendtypeto', params)
+        try:
+            rv = self.callrpc('sendtypeto', self.makeSendParams(total_value, cc_inputs, spend_address, not self.settings.testonly))
+        except Exception:
+            # The view may be out of date
+            self.utxos = None
+            raise
         if self.settings.testonly:
             action = 'Test'
             txid = self.callrpc('decoderawtransaction', [rv['hex'], ])['txid']
         else:
             action = 'Sent'
             txid = rv['txid']
+            self.own_txids.add(txid)
+            for tx in inputs:
+                self.removeUtxo(Prevout(tx['txid'], tx['vout']))
         logging.info('{} tx: {}, inputs {}, value {}.'.format(action, txid, len(cc_inputs), format8(total_value)))
         if self.settings.testonly:
             logging.info('  hex: ' + rv['hex'])
 
-        if len(groups) < 1:
+        if sent_all:
             logging.info('Sent all')
             return False
         return True
@@ -429,6 +886,9 @@ def main():
     parser.add_argument('--minwait', dest='minwait', help='Minimum number of seconds to wait before repeating [1, 3600] (default=1)', type=int, default=1, required=False)
     parser.add_argument('--maxwait', dest='maxwait', help='Maximum number of seconds to wait before repeating [1, 7200] (default=600)', type=int, default=600, required=False)
     parser.add_argument('--loop', dest='loop', help='Exit after creating first transaction if false (default=false)', type=make_boolean, default=True, required=False)
+    parser.add_argument('--resyncevery', dest='resyncevery', help='Fetch all unspent outputs again every n loops [1, 10000] (default=100)', type=int, default=100, required=False)
+    parser.add_argument('--plan', dest='plan', help='Print the transactions needed to move all inputs and exit, nothing is sent if true (default=false)', type=make_boolean, default=False, required=False)
+    parser.add_argument('--simulate', dest='simulate', help='Create all transactions needed to move all inputs and test them against the mempool, nothing is sent if true (default=false)', type=make_boolean, default=False, required=False)
     parser.add_argument('--testonly', dest='testonly', help='transactions are not submitted if true (default=false)', type=make_boolean, default=False, required=False)
     parser.add_argument('stakeaddress', help='The stake address to send to, read from coldstakingaddress if unset.', default='', nargs='?')
 
@@ -436,10 +896,13 @@ def main():
 
     if args.network not in ['mainnet', 'testnet', 'regtest']:
         raise argparse.ArgumentTypeError('Unknown network')
-    args.minvalue = make_int(args.minvalue)
-    if make_int(args.minvalue) < 1:
+    try:
+        args.minvalue = parse_amount(args.minvalue)
+        args.maxvalue = parse_amount(args.maxvalue)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+    if args.minvalue < 1:
         raise argparse.ArgumentTypeError('Invalid minvalue')
-    args.maxvalue = make_int(args.maxvalue)
     if args.maxvalue < 1:
         raise argparse.ArgumentTypeError('Invalid maxvalue')
     if args.maxinputs < 1 or args.maxinputs > 100:
@@ -448,8 +911,12 @@ def main():
         raise argparse.ArgumentTypeError('Invalid minwait')
     if args.maxwait < args.minwait or args.maxwait > 7200:
         raise argparse.ArgumentTypeError('Invalid maxwait')
+    if args.resyncevery < 1 or args.resyncevery > 10000:
+        raise argparse.ArgumentTypeError('Invalid resyncevery')
     if args.addressgroupings and args.nomix:
         raise argparse.ArgumentTypeError('Incompatible combination: --nomix, --addressgroupings')
+    if args.plan and args.simulate:
+        raise argparse.ArgumentTypeError('Incompatible combination: --plan, --simulate')
 
     args.datadir = os.path.expanduser(args.datadir)
 